@@ -52,7 +52,7 @@ if cust_df:
     import scipy
     from scipy.optimize import minimize
 
-    def msr(prices, riskfree_rate=0, method='SLSQP'):
+    def msr(prices, riskfree_rate=0, method='SLSQP', cov_estimator=None, cov_engine=None):
         n = prices.shape[1] #no of assets, since er row headers will be the number of assets
         init_guess = np.repeat(1/n, n) 
         bounds = ((0.0, 1.0),)*n
@@ -67,7 +67,19 @@ if cust_df:
                 return -(r - riskfree_rate/252)/vol
 
         er = prices.pct_change().mean()
-        cov = np.array(prices.pct_change().cov())
+        #cov_estimator is any of the erk estimators taking daily returns e.g. erk.ewma_cov, the sample covariance by default
+        #cov_engine (an erk.RollingCovariance on all the returns) lets it update the previous window's estimate
+        if cov_estimator is not None:
+            cov = np.array(cov_estimator(prices.pct_change().dropna(), cov_engine=cov_engine))
+        else:
+            cov = np.array(prices.pct_change().cov())
+
+        #'QP' solves the convex tangency portfolio problem, SLSQP is only used if it finds no solution
+        if method == 'QP':
+            weights = erk.msr_qp(riskfree_rate/252, er, cov)
+            if weights is not None:
+                return weights
+            method = 'SLSQP'
 
         result = minimize(neg_sharpe_ratio, init_guess,
                                args= (riskfree_rate, er, cov), method = method,   #Args means additional arguments required i.e. covariance matrix here for the portfolio vol function above #"SLSQP" is the method name for "Quadratic Optimization"
@@ -79,7 +91,7 @@ if cust_df:
 
     #Max Sharpe Backtester Function
     @st.cache(allow_output_mutation=True)
-    def sharpe_bt(prices, rf_rate=0, rebalancing='Quarterly', lookback=90):
+    def sharpe_bt(prices, rf_rate=0, rebalancing='Quarterly', lookback=90, cov_estimator=None):
         """
         """
         df = prices.copy()
@@ -101,12 +113,13 @@ if cust_df:
         mask = (period1 != period2)
         rebal = df[mask.values]
         weights = pd.DataFrame(index=df.columns)
+        cov_engine = erk.RollingCovariance(df.pct_change().iloc[1:]) if cov_estimator is not None else None
 
         #calculate % weights based on Max Sharpe Allocation
         for i in range(len(rebal)):
             end = rebal.index[i]
             start = end - timedelta(days=lookback)
-            weights = weights.join(pd.DataFrame(msr(df[start:end], rf_rate/100, 'SLSQP'), index=df.columns, columns=[rebal.index[i]]))
+            weights = weights.join(pd.DataFrame(msr(df[start:end], rf_rate/100, 'QP', cov_estimator, cov_engine), index=df.columns, columns=[rebal.index[i]]))
 
         weights= weights.T
         weights.index.name='Date'
@@ -135,9 +148,11 @@ if cust_df:
         rebal_period = d1.selectbox('Rebalancing Frequency',('Quarterly', 'Monthly'))
         lookback = d2.number_input('Lookback Period (in business days): ', min_value=30, max_value=252*3, value=90, step=1)
         rf_rate = d9.number_input('Enter Risk Free Rate (%, Annualized)', value=0.0, step=0.01, key='optimizer')
+        cov_method = d1.selectbox('Covariance Estimator', ('Sample', 'EWMA (RiskMetrics)'))
 
+    cov_estimator = erk.ewma_cov if cov_method == 'EWMA (RiskMetrics)' else None
     #if st.button("Run Maximum Sharpe Ratio Optimization"):
-    port = sharpe_bt(cust_df, rf_rate, rebal_period, lookback)
+    port = sharpe_bt(cust_df, rf_rate, rebal_period, lookback, cov_estimator)
 
     #Show Portfolio Allocations Over Time
     st.write("## Max Sharpe Ratio Allocations - "+rebal_period+"  Rebalanced")
@@ -159,7 +174,7 @@ if cust_df:
         d5, d6 = st.columns(2)
         start= d5.date_input("Custom Start Date: ", value=date(2020,1,1), min_value=tri.index[0])
         end = d6.date_input("Custom End Date: ", value=tri.index[-1], max_value=tri.index[-1])
-        tri = pd.DataFrame((1+tri[start:end].pct_change().dropna(0)).cumprod()-1)
+        tri = erk.ReturnIndex(tri).cumulative(start, end).iloc[1:]
         fig = px.line(tri)
         fig.update_layout(     xaxis_title='Date',
                                yaxis_title='Return (%)', font=dict(family="Segoe UI, monospace", size=13, color="#7f7f7f"),
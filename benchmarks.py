@@ -0,0 +1,168 @@
+"""
+Wall-clock benchmarks for the portfolio construction code in edhec_risk_kit / edhec_risk_kit_206
+Run from the repo root with: python benchmarks.py
+"""
+import time
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+import edhec_risk_kit as erk
+import edhec_risk_kit_206 as erk1
+
+
+def random_problem(n_assets, n_periods=240, seed=0):
+    """
+    Returns (er, cov, rets) for a random universe of n_assets with a one factor covariance structure
+    er is a Series, cov a DataFrame and rets a DataFrame of monthly returns
+    """
+    rng = np.random.default_rng(seed)
+    betas = rng.uniform(0.5, 1.5, n_assets)
+    market = rng.normal(0.007, 0.045, n_periods)
+    noise = rng.normal(0, 0.06, (n_periods, n_assets))
+    rets = pd.DataFrame(np.outer(market, betas) + noise + rng.uniform(-0.002, 0.006, n_assets),
+                        columns=[f"A{i}" for i in range(n_assets)])
+    er = erk.annualized_ret(rets, 12)
+    cov = rets.cov()*12
+    return er, cov, rets
+
+
+def best_time(func, repeat=3):
+    """
+    Returns the best wall-clock time in seconds over "repeat" calls of func
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _finite_difference_slsqp(fun, n, args, constraints):
+    """
+    The pre-gradient optimizer call: SLSQP on the long only simplex with the gradients estimated by finite differences
+    """
+    constraints = tuple({k: v for k, v in c.items() if k != 'jac'} for c in constraints)
+    return minimize(fun, np.repeat(1/n, n), args=args, method="SLSQP",
+                    bounds=((0.0, 1.0),)*n, constraints=constraints, options={'disp': False}).x
+
+
+def bench_slsqp_gradients(sizes=(20, 50, 100, 200), repeat=3):
+    """
+    Compares the SLSQP optimizers with analytic gradients against finite difference gradients
+    Returns a DataFrame of wall-clock seconds and the largest weight difference between the two
+    """
+    rows = []
+    for n in sizes:
+        er, cov, rets = random_problem(n)
+        target = er.mean()
+        weights_sum_to_1 = {'type': 'eq', 'fun': lambda w: np.sum(w) - 1}
+        return_met = {'type': 'eq', 'args': (er,), 'fun': lambda w, er: target - erk.portfolio_returns(w, er)}
+        ref_r = rets @ np.repeat(1/n, n)
+        cases = {
+            "minimize_vol": (lambda: _finite_difference_slsqp(erk.portfolio_vol, n, (cov,), (return_met, weights_sum_to_1)),
+                             lambda: erk.minimize_vol(target, er, cov)),
+            "msr": (lambda: _finite_difference_slsqp(erk.neg_sharpe_ratio, n, (0.02, er, cov), (weights_sum_to_1,)),
+                    lambda: erk.msr(0.02, er, cov)),
+            "style_analysis": (lambda: _finite_difference_slsqp(erk.portfolio_tracking_error, n, (ref_r, rets), (weights_sum_to_1,)),
+                               lambda: erk.style_analysis(ref_r, rets).values),
+            "target_risk_contributions": (lambda: _finite_difference_slsqp(erk1.msd_risk, n, (np.repeat(1/n, n), cov), (weights_sum_to_1,)),
+                                          lambda: erk1.target_risk_contributions(np.repeat(1/n, n), cov)),
+        }
+        for name, (finite_diff, analytic) in cases.items():
+            rows.append({"Optimizer": name, "Assets": n,
+                         "Finite Difference (s)": best_time(finite_diff, repeat),
+                         "Analytic Gradient (s)": best_time(analytic, repeat),
+                         "Max |dw|": np.abs(finite_diff() - analytic()).max()})
+    result = pd.DataFrame(rows).set_index(["Optimizer", "Assets"])
+    result["Speedup"] = result["Finite Difference (s)"]/result["Analytic Gradient (s)"]
+    return result
+
+
+def bench_qp(sizes=(200, 500, 1000), repeat=1):
+    """
+    Compares the dedicated QP backend against SLSQP for minimize_vol and gmv
+    Returns a DataFrame of wall-clock seconds, the volatility gap (SLSQP - QP) and the largest weight difference
+    """
+    rows = []
+    for n in sizes:
+        er, cov, rets = random_problem(n, n_periods=2000)
+        target = er.quantile(0.7)
+        cases = {
+            "minimize_vol": lambda backend: erk.minimize_vol(target, er, cov, backend=backend),
+            "gmv": lambda backend: erk.gmv(cov, backend=backend),
+        }
+        for name, solve in cases.items():
+            w_slsqp, w_qp = solve("slsqp"), solve("qp")
+            rows.append({"Optimizer": name, "Assets": n,
+                         "SLSQP (s)": best_time(lambda: solve("slsqp"), repeat),
+                         "QP (s)": best_time(lambda: solve("qp"), repeat),
+                         "Vol Gap": erk.portfolio_vol(w_slsqp, cov) - erk.portfolio_vol(w_qp, cov),
+                         "Max |dw|": np.abs(w_slsqp - w_qp).max()})
+    result = pd.DataFrame(rows).set_index(["Optimizer", "Assets"])
+    result["Speedup"] = result["SLSQP (s)"]/result["QP (s)"]
+    return result
+
+
+def check_cla_ties(sizes=(8, 20, 50), n_points=25):
+    """
+    Compares the CLA backend against QP when expected returns are tied, where the CLA sweep cannot rank the tied assets
+    Returns a DataFrame of the sharpe ratio gap (QP - CLA) of msr and the largest frontier volatility gap (CLA - QP),
+    both should be ~0 (the frontier of all equal returns collapses to the GMV)
+    """
+    rows = []
+    for n in sizes:
+        er, cov, rets = random_problem(n)
+        er = er - er.min() + 0.01
+        top = er.sort_values(ascending=False).index
+        cases = {"distinct": er, "top two tied": er.where(er.index != top[1], er[top[0]]), "all equal": er*0 + er.mean()}
+        for name, mu in cases.items():
+            sharpe = {backend: erk.portfolio_returns(w, mu)/erk.portfolio_vol(w, cov)
+                      for backend, w in (("cla", erk.msr(0, mu, cov, backend="cla")), ("qp", erk.msr(0, mu, cov, backend="qp")))}
+            w_cla = np.array(erk.optimal_weights(n_points, mu, cov, backend="cla"))
+            w_qp = np.array(erk.optimal_weights(n_points, mu, cov, backend="qp")) if mu.nunique() > 1 \
+                else np.tile(erk.gmv(cov, backend="qp"), (n_points, 1))
+            vol_cla, vol_qp = (np.sqrt(np.einsum("ki,ij,kj->k", w, cov.values, w)) for w in (w_cla, w_qp))
+            rows.append({"Returns": name, "Assets": n, "Sharpe Gap": sharpe["qp"] - sharpe["cla"],
+                         "Max Vol Gap": (vol_cla - vol_qp).max()})
+    return pd.DataFrame(rows).set_index(["Returns", "Assets"])
+
+def bench_variance_reduction(n_scenarios=(1024, 4096, 16384), n_replications=20, floor=1.0, n_years=10):
+    """
+    Compares the gbm variance reduction modes against plain sampling on the terminal wealth of n_years monthly paths
+    Each method is replicated n_replications times with independent seeds: the standard errors are the standard
+    deviations of the estimates of the mean terminal wealth and of the probability of ending below floor across
+    replications, and the efficiency is 1/(standard error^2 x CPU seconds) of the mean relative to plain sampling,
+    i.e. how many times fewer CPU seconds the method needs for the same precision
+    """
+    rows = []
+    for n in n_scenarios:
+        for method in (None, "antithetic", "moment_matching", "sobol"):
+            means, breaches, cpu = [], [], 0.0
+            for seed in range(n_replications):
+                rng = np.random.default_rng(seed)
+                start = time.process_time()
+                wealth = erk.terminal_values(erk.gbm(n_years, n, prices=False, rng=rng, variance_reduction=method))
+                cpu += time.process_time() - start
+                means.append(wealth.mean())
+                breaches.append((wealth < floor).mean())
+            rows.append({"Method": method or "plain", "Scenarios": n,
+                         "Mean": np.mean(means), "Std Error (Mean)": np.std(means, ddof=1),
+                         "P(Breach)": np.mean(breaches), "Std Error (P(Breach))": np.std(breaches, ddof=1),
+                         "CPU (s)": cpu/n_replications})
+    result = pd.DataFrame(rows).set_index(["Scenarios", "Method"])
+    efficiency = 1/(result["Std Error (Mean)"]**2*result["CPU (s)"])
+    result["Efficiency vs Plain"] = efficiency/efficiency.xs("plain", level="Method").reindex(result.index, level="Scenarios")
+    return result
+
+
+if __name__ == "__main__":
+    pd.set_option("display.width", 200)
+    print("SLSQP: analytic gradients vs finite differences")
+    print(bench_slsqp_gradients())
+    print("\nMean-variance QP: active set solver vs SLSQP")
+    print(bench_qp())
+    print("\nCritical Line Algorithm vs QP on tied expected returns")
+    print(check_cla_ties())
+    print("\nMonte Carlo: gbm variance reduction vs plain sampling")
+    print(bench_variance_reduction())
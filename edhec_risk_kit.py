@@ -19,6 +19,86 @@ def drawdown(return_series: pd.Series):
                           "Drawdowns": drawdowns
                          })  
 
+
+def drawdown_episodes(growth):
+    """
+    Drawdown episodes of every column of growth, a T x N array of gross returns (1 + r, 1 for the missing returns)
+    An episode runs from a peak of the wealth index to the next one (the recovery) and is kept if it goes under water
+    Returns the flat arrays (column, peak, trough, recovery, depth) of all the episodes, with row positions and -1 for the
+    recovery of an episode still open at the end, and the number of periods each column spent under water
+    """
+    import numpy as np
+    n_periods, n_cols = growth.shape
+    #Wealth index over its previous peak, flattened column by column so that the rows of each column are contiguous
+    ratio = np.cumprod(growth, axis=0)
+    np.divide(ratio, np.maximum.accumulate(ratio, axis=0), out=ratio)
+    ratio = ratio.T.ravel()
+    #Every peak starts a new group of rows and so does the first row of a column, an episode is a group under 1
+    #Marked explicitly, a -100% first return makes that row 0/0 = NaN
+    starts = np.flatnonzero((ratio == 1.0) | (np.arange(ratio.size) % n_periods == 0))
+    lengths = np.diff(np.append(starts, ratio.size))
+    depth = np.minimum.reduceat(ratio, starts)
+    trough = np.minimum.reduceat(np.where(ratio == np.repeat(depth, lengths), np.arange(ratio.size), ratio.size), starts)
+    column = starts//n_periods
+    #The recovery is the peak starting the next group of the same column
+    recovery = np.append(starts[1:], -1)
+    recovery[np.append(column[1:] != column[:-1], True)] = -1
+    under_water = depth < 1.0
+    periods = np.bincount(column[under_water], weights=lengths[under_water] - 1, minlength=n_cols).astype(int)
+    offset = column*n_periods
+    recovery = np.where(recovery >= 0, recovery - offset, -1)
+    return (column[under_water], (starts - offset)[under_water], (trough - offset)[under_water], recovery[under_water],
+            depth[under_water] - 1, periods)
+
+
+def drawdown_stats(r, top_k=5, chunk_size=256):
+    """
+    Drawdown analytics of every column of r (a Series or DataFrame of returns, missing returns count as 0) in a single
+    pass over chunks of chunk_size columns, instead of the full wealth, peaks and drawdowns frames of drawdown()
+    Returns a dict of two DataFrames:
+    "Summary": one row per column with the Max Drawdown, the Peak, Trough and Recovery dates of that drawdown (NaT if it
+    has not recovered yet), its Duration in periods from the peak to the recovery (or to the end), and the Time Under
+    Water i.e. the total number of periods spent below a previous peak
+    "Episodes": the top_k deepest drawdowns of each column, indexed by (column, rank), with the same fields
+    """
+    import numpy as np
+    if isinstance(r, pd.Series):
+        r = r.to_frame()
+    x = r.values.astype(float)
+    n_periods, n_cols = x.shape
+    found = []
+    under_water = np.zeros(n_cols, dtype=int)
+    for first in range(0, n_cols, chunk_size):
+        *episodes, periods = drawdown_episodes(1 + np.nan_to_num(x[:, first:first + chunk_size]))
+        under_water[first:first + chunk_size] = periods
+        #Deepest first within each column, then cut each column's run after top_k episodes
+        order = np.lexsort((episodes[4], episodes[0]))
+        column = episodes[0][order]
+        keep = order[np.arange(column.size) - np.searchsorted(column, column) < top_k]
+        episodes[0] = episodes[0] + first
+        found.append([a[keep] for a in episodes])
+    column, peak, trough, recovery, depth = (np.concatenate(a) for a in zip(*found))
+    rank = np.arange(column.size) - np.searchsorted(column, column)
+    duration = np.where(recovery >= 0, recovery, n_periods - 1) - peak
+
+    def table(depth, peak, trough, recovery, duration, index):
+        dates = lambda pos: pd.Series(r.index[np.maximum(pos, 0)]).where(pos >= 0).values
+        return pd.DataFrame({"Drawdown": depth, "Peak": dates(peak), "Trough": dates(trough),
+                             "Recovery": dates(recovery), "Duration": duration}, index=index)
+
+    episodes = table(depth, peak, trough, recovery, duration,
+                     pd.MultiIndex.from_arrays([r.columns[column], rank + 1], names=[r.columns.name, "Rank"]))
+    #The deepest episode of each column is its max drawdown, columns that never went under water get 0 and no dates
+    deepest = rank == 0
+    fields = []
+    for values, missing in ((depth, 0.0), (peak, -1), (trough, -1), (recovery, -1), (duration, 0)):
+        field = np.full(n_cols, missing, dtype=values.dtype)
+        field[column[deepest]] = values[deepest]
+        fields.append(field)
+    summary = table(*fields, r.columns).rename(columns={"Drawdown": "Max Drawdown"})
+    summary["Time Under Water"] = under_water
+    return {"Summary": summary, "Episodes": episodes}
+
 #Adding a convenience code i.e. last time we had to convert the series, select only hi & low and so on, let's build function that does just that
 def get_ffme_returns():
     """
@@ -126,6 +206,105 @@ def compound(r):
     """
     return np.expm1(np.log1p(r).sum())
 
+
+class ReturnIndex:
+    """
+    Cumulative log return index of a Series or DataFrame of prices, built once and then queried for the compounded
+    return of every column between any two rows in O(1): the return from row i to row j is exp(L[j] - L[i]) - 1
+    Missing prices (holidays, stale quotes) are forward filled, so the return over a gap is booked on the next price,
+    while the rows before a series' first price stay NaN and so does any return that starts there
+    """
+    def __init__(self, prices):
+        if isinstance(prices, pd.Series):
+            prices = prices.to_frame()
+        elif not isinstance(prices, pd.DataFrame):
+            raise TypeError("Expected prices to be a Series or DataFrame")
+        self.index, self.columns = prices.index, prices.columns
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.log_index = np.log(prices.ffill().values.astype(float))
+
+    def locate(self, start=None, end=None):
+        """
+        Row positions of the first row on or after start and the last row on or before end, the rows
+        data[start:end].iloc[0] and data[start:end].iloc[-1] would return (None means the first/last row)
+        """
+        i = 0 if start is None else self.index.searchsorted(pd.Timestamp(start), side="left")
+        j = len(self.index) - 1 if end is None else self.index.searchsorted(pd.Timestamp(end), side="right") - 1
+        return i, j
+
+    def between(self, i, j):
+        """
+        Compounded return of every column from row position i to row position j, NaN if either row is outside the index
+        """
+        n = len(self.index)
+        if not (0 <= i < n and 0 <= j < n):
+            return pd.Series(np.nan, index=self.columns)
+        return pd.Series(np.expm1(self.log_index[j] - self.log_index[i]), index=self.columns)
+
+    def returns(self, start=None, end=None):
+        """
+        Compounded return of every column over the dates from start to end, i.e. the last price on or before end over
+        the first price on or after start, minus one
+        """
+        i, j = self.locate(start, end)
+        if j < i:
+            return pd.Series(np.nan, index=self.columns)
+        return self.between(i, j)
+
+    def trailing(self, periods, end=-1):
+        """
+        Compounded return of every column over the last "periods" rows up to row position end,
+        same as data.pct_change(periods).iloc[end] on the forward filled prices
+        """
+        end = end + len(self.index) if end < 0 else end
+        return self.between(end - periods, end)
+
+    def cumulative(self, start=None, end=None):
+        """
+        Compounded return of every column from the first row on or after start to each row up to end
+        """
+        i, j = self.locate(start, end)
+        return pd.DataFrame(np.expm1(self.log_index[i:j+1] - self.log_index[i]), index=self.index[i:j+1], columns=self.columns)
+
+
+def horizon_returns(prices, horizons, end=None):
+    """
+    Compounded return of every column of prices over several horizons at once, returned as a DataFrame with one row
+    per column of prices and one column per horizon. horizons is a list, or a dict of column name -> horizon, of:
+    an int k for the last k rows (same as pct_change(k).iloc[-1]), "YTD" or "MTD" for the returns since the first row
+    of the year/month of the end date, a date for the returns since the first row on or after it, or a (start, end)
+    tuple of dates (None for the first/last row)
+    end is the last date of all the horizons but the tuples (the last row by default). Only the two rows of each
+    horizon are read off the cumulative log return index, prices can also be a ReturnIndex already built on the panel
+    """
+    import numpy as np
+    index = prices if isinstance(prices, ReturnIndex) else ReturnIndex(prices)
+    labels = list(horizons.keys()) if isinstance(horizons, dict) else list(horizons)
+    specs = list(horizons.values()) if isinstance(horizons, dict) else list(horizons)
+    n = len(index.index)
+    last = index.locate(None, end)[1]
+    starts, ends = np.empty(len(specs), dtype=int), np.empty(len(specs), dtype=int)
+    for h, spec in enumerate(specs):
+        if isinstance(spec, (int, np.integer)):
+            starts[h], ends[h] = last - spec, last
+        elif isinstance(spec, tuple):
+            starts[h], ends[h] = index.locate(*spec)
+        elif isinstance(spec, str) and spec in ("YTD", "MTD"):
+            if not 0 <= last < n:
+                starts[h], ends[h] = -1, last
+                continue
+            anchor = index.index[last].to_period("Y" if spec == "YTD" else "M").start_time
+            starts[h], ends[h] = index.locate(anchor)[0], last
+        else:
+            starts[h], ends[h] = index.locate(spec)[0], last
+    #A horizon is undefined if it starts before the first row, ends after the last one or is empty
+    valid = (starts >= 0) & (ends < n) & (starts <= ends)
+    log_index = index.log_index
+    table = np.expm1(log_index[np.where(valid, ends, 0)] - log_index[np.where(valid, starts, 0)])
+    table[~valid] = np.nan
+    return pd.DataFrame(table.T, index=index.columns, columns=labels)
+
+
 def semideviation(r, periods_per_year):
     """
     Returns Downside Deviation i.e. deviation of returns that are negative
@@ -168,27 +347,96 @@ def is_normal(r, level=0.01): #Says that it takes r as input and a level of conf
     return p_value > level   #Returns True if p_value > 1% or given level and False if not
 
 
+def column_percentiles(x, levels):
+    """
+    Percentiles (in %) of each column of the T x N array x for all the levels at once: a single np.partition along axis 0
+    on the order statistics the levels need, then the same linear interpolation as np.percentile
+    Returns a (levels x N) array, NaN for the columns with missing values like np.percentile
+    """
+    import numpy as np
+    x = np.asarray(x, dtype=float)
+    levels = np.atleast_1d(np.asarray(levels, dtype=float))
+    n = x.shape[0]
+    position = levels/100*(n-1)
+    lo = np.floor(position).astype(int)
+    frac = (position - lo)[:, None]
+    kth = np.unique(lo)
+    part = np.partition(x, kth, axis=0)
+    x_lo = part[lo]
+    #The next order statistic is the smallest value between a partition point and the next one, no need to select it
+    next_kth = dict(zip(kth, np.append(kth[1:], n-1)))
+    x_hi = np.array([part[k+1:next_kth[k]+1].min(axis=0) if k+1 < n else part[k] for k in lo])
+    diff = x_hi - x_lo
+    q = np.where(frac >= 0.5, x_hi - diff*(1-frac), x_lo + diff*frac)     #np.percentile's interpolation, to the last digit
+    q[:, np.isnan(x).any(axis=0)] = np.nan
+    return q
+
 def var_historic(r, level=5):
     """
     Returns the historic Value at Risk(VaR) for a specified level (alpha)
     i.e. returns such that if level =5 then 5% of the time returns may be at or lower than the resulted return
+    level can also be a list of levels, the result then has one row (or value for a Series) per level
     """
     import numpy as np
     
     if isinstance(r, pd.DataFrame):                     #Checks if the return series given is a Dataframe
-        return r.aggregate(var_historic, level=level)   #If it's a Dataframe it applies the check on each column then
+        var = -column_percentiles(r.values, level)      #If it's a Dataframe all the columns are done together by column_percentiles
+        if np.ndim(level) == 0:
+            return pd.Series(var[0], index=r.columns)
+        return pd.DataFrame(var, index=pd.Index(level, name="Level"), columns=r.columns)
     elif isinstance(r, pd.Series):                      #If not a dataframe, checks if it is a series
+        if np.ndim(level) != 0:
+            return var_historic(r.to_frame(), level).iloc[:, 0].rename(r.name)
         return -np.percentile(r, level) #If a series, then applies the VaR formula via numpy, negative sign since we always report VaR as a positive number
     else:
         raise TypeError("Expected r to be a Series or a DataFrame")  #If none of the above then data is not in correct format so raise an error
-        
+
+def column_moments(x):
+    """
+    Number of observations, mean and 2nd, 3rd and 4th central moments (population) of each column of the T x N array x
+    in one demeaning pass, skipping NaNs like the pandas reductions
+    """
+    import numpy as np
+    x = np.asarray(x, dtype=float)
+    observed = ~np.isnan(x)
+    complete = observed.all()
+    n_obs = observed.sum(axis=0)
+    mean = (x if complete else np.where(observed, x, 0.0)).sum(axis=0)/n_obs
+    dev = x - mean if complete else np.where(observed, x - mean, 0.0)      #Missing values add zeros
+    dev2 = dev*dev
+    m2 = dev2.sum(axis=0)/n_obs
+    m3 = np.einsum("ij,ij->j", dev2, dev)/n_obs
+    m4 = np.einsum("ij,ij->j", dev2, dev2)/n_obs
+    return n_obs, mean, m2, m3, m4
+
 from scipy.stats import norm
 def gaussian_var(r, level=5, modified=False):
     """
     Returns the Guassian VaR for a given returns Series or DataFrame at a specified level
     If Modified = True, then returns the Modified Semi-Parametric VaR, as given
     by Cornish-Fisher Modification
+    level can also be a list of levels, the result then has one row (or value for a Series) per level
     """
+    import numpy as np
+    if isinstance(r, pd.DataFrame) or np.ndim(level) != 0:
+        #All the columns and levels together: one moments pass, Z-scores broadcast as (levels x columns)
+        frame = r.to_frame() if isinstance(r, pd.Series) else r
+        n_obs, mean, m2, m3, m4 = column_moments(frame.values)
+        sd = np.sqrt(m2)
+        s, k = m3/sd**3, m4/m2**2
+        Z = norm.ppf(np.atleast_1d(np.asarray(level, dtype=float))/100)[:, None]
+        if modified:
+            Z = (Z +
+                     (Z**2-1)*s/6 +
+                     (Z**3-3*Z)*(k-3)/24 -
+                     (2*Z**3 - 5*Z)*(s**2)/36
+                )
+        var = -(mean + Z*sd)
+        if np.ndim(level) == 0:
+            return pd.Series(var[0], index=frame.columns)
+        var = pd.DataFrame(var, index=pd.Index(level, name="Level"), columns=frame.columns)
+        return var.iloc[:, 0].rename(r.name) if isinstance(r, pd.Series) else var
+
     #Compute Z-Score assuming it was Gaussian
     
     Z = norm.ppf(level/100)             #PPF is Percentage Point Function, specify the probabiltiy in point terms, returns the z-score
@@ -208,12 +456,25 @@ def cvar_historic(r, level=5):
     """
     Returns the historic Conditional Value at Risk(VaR) for a specified level (alpha)
     i.e. returns such that if level =5 then 5% of the time  average returns will be the result
+    level can also be a list of levels, the result then has one row (or value for a Series) per level
     """ 
-    if isinstance(r, pd.Series):                          #Checks if the return series given is a series
+    import numpy as np
+    if isinstance(r, pd.Series) and np.ndim(level) == 0:  #Checks if the return series given is a series
         is_beyond = r <= -var_historic(r, level=level) #checks if return is less than VaR
         return -r[is_beyond].mean()                     #Reports the mean of all returns less than (is_beyond) historic_var
-    elif isinstance(r, pd.DataFrame):                     #If not a series, checks if it is a dataframe
-        return r.aggregate(cvar_historic, level=level)
+    elif isinstance(r, (pd.Series, pd.DataFrame)):      #If not a series, checks if it is a dataframe
+        frame = r.to_frame() if isinstance(r, pd.Series) else r
+        x = frame.values.astype(float)
+        q = column_percentiles(x, level)
+        cvar = np.empty_like(q)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i in range(q.shape[0]):                 #One comparison pass per level over the whole array
+                is_beyond = x <= q[i]
+                cvar[i] = -np.where(is_beyond, x, 0.0).sum(axis=0)/is_beyond.sum(axis=0)
+        if np.ndim(level) == 0:
+            return pd.Series(cvar[0], index=frame.columns)
+        cvar = pd.DataFrame(cvar, index=pd.Index(level, name="Level"), columns=frame.columns)
+        return cvar.iloc[:, 0].rename(r.name) if isinstance(r, pd.Series) else cvar
     else:
         raise TypeError("Expected r to be a Series or a DataFrame")  #If none of the above then data is not in correct format so raise an error
 
@@ -264,6 +525,14 @@ def portfolio_vol(weights, covmat):
     vol= (weights.T @ covmat @ weights)**0.5
     return vol                                 #Square root because this results the variance so to get standard deviation
 
+def portfolio_vol_gradient(weights, covmat):
+    """
+    Returns the gradient of the portfolio volatility with respect to the weights
+    The variance w'Cw has gradient 2Cw, so by the chain rule the volatility has gradient Cw/vol
+    """
+    marginal = np.asarray(covmat) @ weights     #Marginal contribution of each asset i.e. Cov @ w
+    return marginal/np.sqrt(weights @ marginal)
+
 def plot_ef2(n_points, er, cov, style=".-",color="goldenrod"):
     """
     Plots a 2-Asset Efficient Frontier
@@ -284,16 +553,80 @@ def plot_ef2(n_points, er, cov, style=".-",color="goldenrod"):
 
 
 
-def minimize_vol(target_return, er, cov):
+def qp_min_variance(cov, A, b, lower=0.0, upper=1.0, max_iter=100, tol=1e-10):
+    """
+    Dedicated solver for the mean-variance quadratic program min w'Cw subject to A @ w = b and lower <= w <= upper
+    It is a primal-dual active set method: guess which weights sit on a bound, solve the equality constrained problem
+    for the others with one linear (KKT) system, then update the guess from the weights and the bound multipliers.
+    It usually settles in a handful of iterations. Returns None if it does not, or if the problem is degenerate/infeasible,
+    so the caller can fall back to SLSQP
+    """
+    import numpy as np
+    cov_v = np.asarray(cov, dtype=float)
+    A = np.atleast_2d(np.asarray(A, dtype=float))
+    b = np.atleast_1d(np.asarray(b, dtype=float))
+    n, m = cov_v.shape[0], A.shape[0]
+    lower = np.broadcast_to(np.asarray(lower, dtype=float), (n,))
+    upper = np.broadcast_to(np.asarray(upper, dtype=float), (n,))
+    c = np.diag(cov_v).mean()                      #Scales the weights to the size of the multipliers when picking the active set
+
+    #Start from the problem without bounds. z = Cw - A'y are the bound multipliers, >= 0 at the lower bound, <= 0 at the upper bound
+    at_lower = np.zeros(n, dtype=bool)
+    at_upper = np.zeros(n, dtype=bool)
+    for _ in range(max_iter):
+        free = ~(at_lower | at_upper)
+        k = free.sum()
+        w_fixed = np.where(at_lower, lower, np.where(at_upper, upper, 0.0))
+        #KKT system of the free weights: [C_FF -A_F'; A_F 0] [w_F; y] = [-C_F,fixed w_fixed; b - A w_fixed]
+        kkt = np.zeros((k + m, k + m))
+        kkt[:k, :k] = cov_v[np.ix_(free, free)]
+        kkt[:k, k:] = -A[:, free].T
+        kkt[k:, :k] = A[:, free]
+        rhs = np.concatenate([-cov_v[free] @ w_fixed, b - A @ w_fixed])
+        try:
+            sol = np.linalg.solve(kkt, rhs)
+        except np.linalg.LinAlgError:
+            return None
+        w = w_fixed.copy()
+        w[free] = sol[:k]
+        z = cov_v @ w - A.T @ sol[k:]
+        z[free] = 0.0
+
+        new_lower = z - c*(w - lower) > tol*c
+        new_upper = z - c*(w - upper) < -tol*c
+        if (new_lower == at_lower).all() and (new_upper == at_upper).all():
+            break
+        at_lower, at_upper = new_lower, new_upper & ~new_lower
+    else:
+        return None
+
+    #Optimality check: feasible weights and bound multipliers of the right sign
+    scale = max(1.0, np.abs(z).max())
+    if (w < lower - 1e-9).any() or (w > upper + 1e-9).any() or np.abs(A @ w - b).max() > 1e-9 \
+            or (z[at_lower] < -1e-9*scale).any() or (z[at_upper] > 1e-9*scale).any():
+        return None
+    return np.clip(w, lower, upper)
+
+def minimize_vol(target_return, er, cov, init_guess=None, backend="slsqp"):
     """
     Gives minimum volatility portfolio weights for a given level of expected return for n-asset portfolio
+    init_guess is the starting point of the optimizer, the equally weighted portfolio if not given
+    backend="qp" solves it with qp_min_variance and only runs SLSQP if that does not converge
     """
     import numpy as np
     import edhec_risk_kit as erk
     from scipy.optimize import minimize
     
+    if backend == "qp":
+        weights = erk.qp_min_variance(cov, np.vstack([np.ones(er.shape[0]), np.asarray(er, dtype=float)]), [1.0, target_return])
+        if weights is not None:
+            return weights
+    elif backend != "slsqp":
+        raise ValueError(f"backend must be one of: slsqp, qp; got {backend!r}")
+
     n = er.shape[0] #no of assets, since er row headers will be the number of assets
-    init_guess = np.repeat(1/n, n) #Initial guess of what the weights should  be for a target return on portfolio, Equally weighted portfolio.
+    if init_guess is None:
+        init_guess = np.repeat(1/n, n) #Initial guess of what the weights should  be for a target return on portfolio, Equally weighted portfolio.
     #Repeat function inputs, 1. The number to repeated 
     #                        2. No. of times you want to repeat the number
     
@@ -304,17 +637,21 @@ def minimize_vol(target_return, er, cov):
     return_met = {
         'type':'eq',      #constraint type is equality
         'args': (er,),    #extra argument required is er
-        'fun': lambda weights, er: target_return - erk.portfolio_returns(weights, er)
+        'fun': lambda weights, er: target_return - erk.portfolio_returns(weights, er),
+        'jac': lambda weights, er: -np.asarray(er, dtype=float)   #Constraint is linear in the weights, so its Jacobian is just -er
     }
-    
+
     weights_sum_to_1 = {
         'type':'eq',
-        'fun': lambda weights: np.sum(weights)-1
+        'fun': lambda weights: np.sum(weights)-1,
+        'jac': lambda weights: np.ones_like(weights)
     }
-    
+
     #Calling the scipy.optimize function of "Minimize", now that we have all the inputs i.e. Function, Constraints, Bounds
+    #jac supplies the closed form gradient so SLSQP does not estimate it by finite differences (n+1 extra calls per iteration)
     results = minimize(erk.portfolio_vol, init_guess,
                        args= (cov,), method = "SLSQP",   #Args means additional arguments required i.e. covariance matrix here for the portfolio vol function above #"SLSQP" is the method name for "Quadratic Optimization"
+                       jac=erk.portfolio_vol_gradient,
                        bounds=bounds,                 #Bounds define minimum and maximum weights as we defined above
                        constraints=(return_met, weights_sum_to_1),
                        options={'disp':False}
@@ -322,28 +659,264 @@ def minimize_vol(target_return, er, cov):
     return results.x
                        
     
-def optimal_weights(n_points, er, cov):
+def min_vol_on_active_set(target_return, er, cov, prev_weights, tol=1e-6):
+    """
+    Re-solves minimize_vol over the assets held in prev_weights only (the active set of a neighbouring frontier point)
+    and checks the optimality (KKT) conditions of the full long-only problem for the assets that were left out.
+    Returns the full weight vector, or None if the reduced problem misses the target or an excluded asset should enter
+    """
+    er_v = np.asarray(er, dtype=float)
+    cov_v = np.asarray(cov, dtype=float)
+    held = prev_weights > tol
+    if held.sum() < 2 or held.all():     #Nothing to gain, or not enough assets to pin down the multipliers
+        return None
+    sub_w = minimize_vol(target_return, er_v[held], cov_v[np.ix_(held, held)],
+                         init_guess=prev_weights[held]/prev_weights[held].sum())
+    weights = np.zeros(er_v.shape[0])
+    weights[held] = sub_w
+    if abs(weights @ er_v - target_return) > tol or abs(weights.sum() - 1) > tol:
+        return None
+    #On the assets strictly inside their bounds the gradient is a combination of the two equality constraints: g = l1*er + l2
+    grad = portfolio_vol_gradient(weights, cov_v)
+    free = (weights > tol) & (weights < 1 - tol)
+    if free.sum() < 2:
+        return None
+    lambdas = np.linalg.lstsq(np.column_stack([er_v[free], np.ones(free.sum())]), grad[free], rcond=None)[0]
+    #An asset at zero must not be able to reduce the volatility i.e. its reduced cost g_i - l1*er_i - l2 must be non-negative
+    reduced_cost = grad - lambdas[0]*er_v - lambdas[1]
+    if (reduced_cost[~held] < -tol*np.abs(grad).max()).any():
+        return None
+    return weights
+
+def corner_portfolios(er, cov, lower=0.0, upper=1.0):
+    """
+    Critical Line Algorithm (Markowitz): traces the whole efficient frontier of the fully invested portfolio with
+    lower <= w <= upper (scalars or one value per asset) in a single pass.
+    The frontier solves min w'Cw/2 - lambda*er'w for lambda going from +inf (maximum return portfolio) down to 0 (GMV),
+    and between two events (an asset hitting a bound or leaving one) the weights are linear in lambda, so the
+    corner portfolios at the events pin down every frontier point exactly (see frontier_weights)
+    Returns a DataFrame with one row of weights per corner portfolio, indexed by lambda, from the highest return to the GMV
+    """
+    import numpy as np
+    import pandas as pd
+    mu = np.asarray(er, dtype=float)
+    cov_v = np.asarray(cov, dtype=float)
+    n = mu.shape[0]
+    lower = np.broadcast_to(np.asarray(lower, dtype=float), (n,)).copy()
+    upper = np.broadcast_to(np.asarray(upper, dtype=float), (n,)).copy()
+    if (lower > upper).any() or lower.sum() > 1 or upper.sum() < 1:
+        raise ValueError("The bounds do not admit a fully invested portfolio")
+
+    #Starting corner (lambda = +inf): fill the assets to their upper bound in decreasing order of expected return,
+    #the asset that completes the budget is the first free asset
+    w = lower.copy()
+    for i in np.argsort(-mu, kind="stable"):
+        w[i] = lower[i] + min(upper[i] - lower[i], 1 - w.sum())
+        if w.sum() >= 1 - 1e-12:
+            break
+    free = np.zeros(n, dtype=bool)
+    free[i] = True
+    #Assets tied with the first free asset on expected return cannot be ranked by the sweep: their gradient does not move
+    #with lambda. The lambda = +inf corner is then the minimum variance split of the tied assets' share of the budget,
+    #found with primal active set steps (on a tied free set b = 0 so the free weights solve to a for any lambda)
+    tied = mu == mu[i]
+    tol = 1e-12*np.diag(cov_v).max()
+    for _ in range(10*n if tied.sum() > 1 else 0):
+        F, B = free, ~free
+        inv = np.linalg.solve(cov_v[np.ix_(F, F)], np.column_stack([np.ones(F.sum()), cov_v[np.ix_(F, B)] @ w[B]]))
+        u, z = inv[:, 0], inv[:, 1]
+        gamma_0 = (1 - w[B].sum() + z.sum())/u.sum()
+        step = gamma_0*u - z - w[F]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(step < 0, (lower[F] - w[F])/step, np.where(step > 0, (upper[F] - w[F])/step, np.inf))
+        if F.sum() > 1 and t.min() < 1:                         #Stop at the first bound in the way, that asset leaves
+            w[F] += t.min()*step
+            j = np.flatnonzero(F)[t.argmin()]
+            w[j] = lower[j] if step[t.argmin()] < 0 else upper[j]
+            free[j] = False
+            continue
+        w[F] += step
+        c = cov_v[np.ix_(B, F)] @ w[F] + cov_v[np.ix_(B, B)] @ w[B] - gamma_0
+        at_lower = w[B] <= lower[B]
+        violated = tied[B] & np.where(at_lower, c < -tol, c > tol)
+        if not violated.any():
+            break
+        free[np.flatnonzero(B)[np.abs(np.where(violated, c, 0.0)).argmax()]] = True
+    lambdas, corners = [np.inf], [w.copy()]
+
+    lam = np.inf
+    for _ in range(10*n + 10):                                  #Every asset enters and leaves a bound a handful of times at most
+        F, B = free, ~free
+        #On the free assets: C_FF w_F + C_FB w_B = lambda*mu_F + gamma, with gamma set by the budget constraint
+        #which makes both w_F = a + lambda*b and the gradient of the bounded assets g_B = c + lambda*d linear in lambda
+        inv = np.linalg.solve(cov_v[np.ix_(F, F)], np.column_stack([np.ones(F.sum()), mu[F], cov_v[np.ix_(F, B)] @ w[B]]))
+        u, v, z = inv[:, 0], inv[:, 1], inv[:, 2]
+        gamma_0 = (1 - w[B].sum() + z.sum())/u.sum()
+        gamma_1 = -v.sum()/u.sum()
+        a, b = gamma_0*u - z, v + gamma_1*u
+        c = cov_v[np.ix_(B, F)] @ a + cov_v[np.ix_(B, B)] @ w[B] - gamma_0
+        d = cov_v[np.ix_(B, F)] @ b - mu[B] - gamma_1
+
+        #Next event below the current lambda: a free asset hitting a bound...
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hit = np.where(b > 0, (lower[F] - a)/b, np.where(b < 0, (upper[F] - a)/b, -np.inf))
+            #...or a bounded asset whose gradient g_i changes sign i.e. it would improve the objective by moving off its bound
+            at_lower = w[B] <= lower[B]
+            enter = np.where((at_lower & (d > 0)) | (~at_lower & (d < 0)), -c/d, -np.inf)
+        ceiling = lam - 1e-12*max(1.0, abs(lam)) if np.isfinite(lam) else np.inf
+        hit[~(hit < ceiling)] = -np.inf
+        #A free asset that already sits on a bound and is pushed through it leaves at once (degenerate corner)
+        hit[((b > 0) & (w[F] <= lower[F] + 1e-12)) | ((b < 0) & (w[F] >= upper[F] - 1e-12))] = lam
+        enter[~(enter < ceiling)] = -np.inf
+        if F.sum() == 1:                                        #The last free asset is pinned by the budget
+            hit[:] = -np.inf
+        lam_hit = hit.max() if hit.size else -np.inf
+        lam_enter = enter.max() if enter.size else -np.inf
+        lam = max(lam_hit, lam_enter, 0.0)
+
+        w[F] = np.clip(a + lam*b, lower[F], upper[F])
+        lambdas.append(lam)
+        corners.append(w.copy())
+        if lam == 0.0:                                          #lambda = 0 is the global minimum variance portfolio
+            break
+        if lam_hit >= lam_enter:
+            j = np.flatnonzero(F)[hit.argmax()]
+            w[j] = lower[j] if b[hit.argmax()] > 0 else upper[j]
+            free[j] = False
+        else:
+            free[np.flatnonzero(B)[enter.argmax()]] = True
+
+    columns = er.index if isinstance(er, pd.Series) else None
+    return pd.DataFrame(corners, index=pd.Index(lambdas, name="Lambda"), columns=columns)
+
+def frontier_weights(target_returns, er, cov, lower=0.0, upper=1.0):
+    """
+    Minimum volatility weights for each of the target returns, interpolated exactly between the corner portfolios
+    Targets above the GMV return come from the efficient branch, targets below it from the CLA run on -er
+    (the lower, inefficient branch that optimal_weights also covers)
+    Returns a list of weight arrays like optimal_weights
+    """
+    import numpy as np
+    mu = np.asarray(er, dtype=float)
+    target_returns = np.atleast_1d(np.asarray(target_returns, dtype=float))
+    weights = np.empty((target_returns.shape[0], mu.shape[0]))
+    upper_branch = corner_portfolios(mu, cov, lower, upper).values
+    gmv_return = upper_branch[-1] @ mu
+    for sign, corners in ((1, upper_branch), (-1, None)):
+        mask = sign*target_returns >= sign*gmv_return
+        if not mask.any():
+            continue
+        if corners is None:
+            corners = corner_portfolios(-mu, cov, lower, upper).values
+        #Corner returns fall along the path, np.interp style lookup needs them increasing
+        corners = corners[::-1]
+        rets = sign*(corners @ mu)
+        t = sign*target_returns[mask]
+        if corners.shape[0] == 1:
+            weights[mask] = corners[0]
+            continue
+        k = np.clip(np.searchsorted(rets, t, side="right") - 1, 0, corners.shape[0] - 2)
+        span = rets[k + 1] - rets[k]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s = np.clip(np.where(span > 0, (t - rets[k])/span, 0.0), 0, 1)
+        weights[mask] = corners[k] + s[:, None]*(corners[k + 1] - corners[k])
+    return list(weights)
+
+def optimal_weights(n_points, er, cov, warm_start=True, reuse_active_set=False, backend="slsqp"):
     """
     List of weights to run the optimizer on, to minimize the volatility
+    warm_start seeds each solve with the weights of the previous frontier point rather than the equally weighted portfolio
+    reuse_active_set first re-solves over the previous point's holdings only (see min_vol_on_active_set),
+    falling back to the full problem whenever an excluded asset should enter
+    backend="cla" interpolates every point from the corner portfolios of the Critical Line Algorithm instead,
+    backend="qp" solves each point with qp_min_variance (see minimize_vol)
     """
     import numpy as np
     import pandas as pd
     import edhec_risk_kit as erk
     target_rets = np.linspace(er.min(), er.max(), n_points) #Our minimize vol function from scipy optimize will give optimal weights if we provide target returns,
     #so this func gives the target returns ranging from lowest to highest individual asset returns and linearly spaces it
-    weights = [erk.minimize_vol(target_return, er, cov) for target_return in target_rets]
+    if backend == "cla":
+        return erk.frontier_weights(target_rets, er, cov)
+    elif backend == "qp":
+        return [erk.minimize_vol(target_return, er, cov, backend="qp") for target_return in target_rets]
+    elif backend != "slsqp":
+        raise ValueError(f"backend must be one of: slsqp, cla, qp; got {backend!r}")
+    weights = []
+    prev_weights = None
+    for target_return in target_rets:
+        w = None
+        if reuse_active_set and prev_weights is not None:
+            w = erk.min_vol_on_active_set(target_return, er, cov, prev_weights)
+        if w is None:
+            w = erk.minimize_vol(target_return, er, cov, init_guess=prev_weights if warm_start else None)
+        weights.append(w)
+        prev_weights = w    #Adjacent frontier points have almost identical solutions
     return weights
      
 
-#Maximum Sharpe Ratio Portfolio Weights Generation Code    
-def msr(riskfree_rate, er, cov):
+#Defining the negative sharpe ratio that we want to minimize i.e. maximize the sharpe ratio
+def neg_sharpe_ratio(weights, riskfree_rate, er, cov):
+    """
+    Returns the negative of the sharpe ratio given the weights
+    """
+    r = portfolio_returns(weights, er)
+    vol = portfolio_vol(weights, cov)
+    return -(r - riskfree_rate)/vol
+
+def neg_sharpe_ratio_gradient(weights, riskfree_rate, er, cov):
+    """
+    Returns the gradient of the negative sharpe ratio with respect to the weights
+    i.e. -er/vol + (r - riskfree_rate)*(Cov @ w)/vol**3
+    """
+    er = np.asarray(er, dtype=float)
+    marginal = np.asarray(cov) @ weights
+    vol = np.sqrt(weights @ marginal)
+    excess_ret = weights @ er - riskfree_rate
+    return -er/vol + excess_ret*marginal/vol**3
+
+def inverse_cov_solve(cov, x):
+    """
+    Returns inverse(cov) @ x through a Cholesky factorisation, or None if cov is not positive definite
+    """
+    import numpy as np
+    from scipy.linalg import cho_factor, cho_solve
+    try:
+        return cho_solve(cho_factor(np.asarray(cov, dtype=float)), np.asarray(x, dtype=float))
+    except np.linalg.LinAlgError:
+        return None
+
+#Maximum Sharpe Ratio Portfolio Weights Generation Code
+def msr(riskfree_rate, er, cov, backend="slsqp", allow_short=False):
     """
     Gives the sharpe ratio portfolio returns & weights for a multi-asset portfolio
+    backend="cla" searches the segments between the corner portfolios of the Critical Line Algorithm instead of running SLSQP,
+    backend="qp" solves the convex tangency problem of msr_qp (SLSQP is still used if that does not converge),
+    backend="closed" tries the closed form tangency portfolio inverse(cov) @ (er - rf) first and only solves the long only
+    problem (with "qp") when that has negative weights
+    allow_short=True drops the long only bounds and returns the closed form tangency portfolio
     """
     import numpy as np
     import edhec_risk_kit as erk
     from scipy.optimize import minimize
     
+    if allow_short or backend == "closed":
+        y = erk.inverse_cov_solve(cov, np.asarray(er, dtype=float) - riskfree_rate)
+        if allow_short:
+            if y is None or y.sum() <= 0:
+                raise ValueError("No tangency portfolio: cov is not positive definite or the frontier lies below the riskfree rate")
+            return y/y.sum()
+        if y is not None and y.sum() > 0 and (y >= 0).all():      #Bounds are not active, so this is also the long only optimum
+            return y/y.sum()
+        backend = "qp"
+
+    if backend in ("cla", "qp"):
+        weights = erk.msr_cla(riskfree_rate, er, cov) if backend == "cla" else erk.msr_qp(riskfree_rate, er, cov)
+        if weights is not None:
+            return weights
+    elif backend != "slsqp":
+        raise ValueError(f"backend must be one of: slsqp, cla, qp, closed; got {backend!r}")
+
     n = er.shape[0] #no of assets, since er row headers will be the number of assets
     init_guess = np.repeat(1/n, n) #Initial guess of what the weights should  be for a target return on portfolio, Equally weighted portfolio.
     #Repeat function inputs, 1. The number to repeated 
@@ -356,21 +929,14 @@ def msr(riskfree_rate, er, cov):
     
     weights_sum_to_1 = {
         'type':'eq',
-        'fun': lambda weights: np.sum(weights)-1
+        'fun': lambda weights: np.sum(weights)-1,
+        'jac': lambda weights: np.ones_like(weights)
     }
-    
-    #Defining the negative sharpe ratio that we want to minimize i.e. maximize the sharpe ratio
-    def neg_sharpe_ratio(weights, riskfree_rate, er, cov):
-        """
-        Returns the negative of the sharpe ratio given the weights
-        """
-        r = portfolio_returns(weights, er)
-        vol = portfolio_vol(weights, cov)
-        return -(r - riskfree_rate)/vol
-    
+
     #Calling the scipy.optimize function of "Minimize", now that we have all the inputs i.e. Function, Constraints, Bounds
     results = minimize(neg_sharpe_ratio, init_guess,
                        args= (riskfree_rate, er, cov), method = "SLSQP",   #Args means additional arguments required i.e. covariance matrix here for the portfolio vol function above #"SLSQP" is the method name for "Quadratic Optimization"
+                       jac=neg_sharpe_ratio_gradient,
                        bounds=bounds,                 #Bounds define minimum and maximum weights as we defined above
                        constraints=(weights_sum_to_1,),
                        options={'disp':False}
@@ -378,25 +944,93 @@ def msr(riskfree_rate, er, cov):
     return results.x
 
 
-def gmv(cov):
+def msr_qp(riskfree_rate, er, cov):
+    """
+    Maximum Sharpe Ratio weights as a convex problem: with y = w/k for k > 0 the sharpe ratio of w is 1/sqrt(y'Cy)
+    on the plane (er - rf)'y = 1, so the long only tangency portfolio is the minimum variance y on that plane with y >= 0,
+    normalised to sum to 1 (the budget constraint is absorbed by the scaling)
+    Returns None if no asset beats the riskfree rate or the QP does not converge
+    """
+    import numpy as np
+    excess_ret = np.asarray(er, dtype=float) - riskfree_rate
+    if (excess_ret <= 0).all():
+        return None
+    y = qp_min_variance(cov, excess_ret[None, :], [1.0], lower=0.0, upper=np.inf)
+    if y is None or y.sum() <= 0:
+        return None
+    return y/y.sum()
+
+def msr_cla(riskfree_rate, er, cov):
+    """
+    Maximum Sharpe Ratio weights from the corner portfolios: the tangency portfolio lies on the efficient branch and along
+    each segment w0 + s*(w1 - w0) the sharpe ratio (p + q*s)/sqrt(A + 2B*s + C*s**2) peaks at s = (pB - qA)/(qB - pC)
+    Returns None if no asset beats the riskfree rate (the tangency portfolio is then not on the efficient branch)
+    """
+    import numpy as np
+    if (np.asarray(er, dtype=float) - riskfree_rate <= 0).all():
+        return None
+    corners = corner_portfolios(er, cov).values
+    if corners.shape[0] == 1:
+        return corners[0]
+    mu = np.asarray(er, dtype=float) - riskfree_rate
+    cov_v = np.asarray(cov, dtype=float)
+    w0, dw = corners[:-1], np.diff(corners, axis=0)
+    p, q = w0 @ mu, dw @ mu
+    A = np.einsum("ki,ij,kj->k", w0, cov_v, w0)
+    B = np.einsum("ki,ij,kj->k", w0, cov_v, dw)
+    C = np.einsum("ki,ij,kj->k", dw, cov_v, dw)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s_star = np.nan_to_num((p*B - q*A)/(q*B - p*C), nan=0.0, posinf=0.0, neginf=0.0)
+    candidates = np.column_stack([np.zeros_like(p), np.ones_like(p), np.clip(s_star, 0, 1)])
+    sharpe = (p[:, None] + q[:, None]*candidates)/np.sqrt(A[:, None] + 2*B[:, None]*candidates + C[:, None]*candidates**2)
+    k, j = np.unravel_index(np.nanargmax(sharpe), sharpe.shape)
+    return w0[k] + candidates[k, j]*dw[k]
+
+def gmv(cov, backend="slsqp", allow_short=False):
     """
     Global Minimum Volatility Portfolio Weights (GMV): Returns the portfolio weights that minimizes the portfolio volatility for a given covariance matrix
+    backend="cla" takes the last corner portfolio (lambda = 0) of the Critical Line Algorithm,
+    backend="qp" solves it with qp_min_variance (SLSQP is still used if that does not converge),
+    backend="closed" tries the closed form inverse(cov) @ 1 / (1' inverse(cov) @ 1) first and only solves the long only
+    problem (with "qp") when that has negative weights
+    allow_short=True drops the long only bounds and returns the closed form GMV
     """
     import numpy as np
     n = cov.shape[0]
+    if allow_short or backend == "closed":
+        y = inverse_cov_solve(cov, np.ones(n))
+        if allow_short:
+            if y is None:
+                raise ValueError("cov must be positive definite")
+            return y/y.sum()
+        if y is not None and (y >= 0).all():                    #Bounds are not active, so this is also the long only GMV
+            return y/y.sum()
+        backend = "qp"
+
+    if backend == "cla":
+        #Any expected returns lead to the same lambda = 0 corner, -variance avoids ties in the starting portfolio
+        return corner_portfolios(-np.diag(np.asarray(cov, dtype=float)), cov).values[-1]
+    elif backend == "qp":
+        weights = qp_min_variance(cov, np.ones((1, n)), [1.0])
+        if weights is not None:
+            return weights
+    elif backend != "slsqp":
+        raise ValueError(f"backend must be one of: slsqp, cla, qp, closed; got {backend!r}")
     return msr(0, np.repeat(1, n), cov) #You assume mean returns to be 1 and the same for all assets in the matrix and maximize sharpe so the only way to improve is by reducing volatility, that's what we want, global minimum volatility portfolio weights
 
 
 #Efficient Frontier Plotting Code given weights, expected returns & covariance matrix
 
-def plot_ef(n_points, er, cov, show_cml=False, riskfree_rate=0, show_ew=False, show_gmv=False, style=".-",color="goldenrod"):
+def plot_ef(n_points, er, cov, show_cml=False, riskfree_rate=0, show_ew=False, show_gmv=False, style=".-",color="goldenrod", reuse_active_set=False, backend="slsqp"):
     """
     Plots a Multi-Asset Efficient Frontier with the Capital Market Line if needed
+    backend is passed on to optimal_weights and gmv ("slsqp", "cla" or "qp"), the CML tangency portfolio
+    uses the convex msr backend "qp" unless backend is "cla"
     """
     import numpy as np
     import pandas as pd
     import edhec_risk_kit as erk
-    weights = optimal_weights(n_points, er, cov)
+    weights = optimal_weights(n_points, er, cov, reuse_active_set=reuse_active_set, backend=backend)
     rets = [portfolio_returns(w, er) for w in weights]
     vols = [portfolio_vol(w, cov) for w in weights]
     eff_frontier = pd.DataFrame({"Returns": rets,
@@ -413,7 +1047,7 @@ def plot_ef(n_points, er, cov, show_cml=False, riskfree_rate=0, show_ew=False, s
 
     if show_gmv:                                               #Global Minimum Volatility Portfolio Weights & Plot on Chart: Only a function of volatility
         n = er.shape[0]
-        w_gmv = gmv(cov)
+        w_gmv = gmv(cov, backend=backend)
         r_gmv = portfolio_returns(w_gmv, er)
         vol_gmv = portfolio_vol(w_gmv, cov)
         #Display Global Minimum Volatility Portfolio (GMV)
@@ -421,7 +1055,7 @@ def plot_ef(n_points, er, cov, show_cml=False, riskfree_rate=0, show_ew=False, s
     
     if show_cml:
         ax.set_xlim(left = 0)
-        w_msr = msr(riskfree_rate, er, cov)                 #Generates the weights of the Max Sharpe Ratio Portfolio
+        w_msr = msr(riskfree_rate, er, cov, backend="cla" if backend == "cla" else "qp") #Generates the weights of the Max Sharpe Ratio Portfolio
         r_msr = portfolio_returns(w_msr, er) #Gives the Y-axis (Return) point of the Max Sharpe Ratio Portfolio
         vol_msr = portfolio_vol(w_msr, cov)  #Gives the X-axis (Volatility) point of the Max Sharpe Ratio Portfolio
         #Add CML
@@ -431,128 +1065,205 @@ def plot_ef(n_points, er, cov, show_cml=False, riskfree_rate=0, show_ew=False, s
         
     return ax  
 
+def cppi_core(risky_r, safe_r, m=3, start=1000, floor=0.8, drawdown=None, history=True):
+    """
+    CPPI engine on T x N float arrays of risky and safe returns, with the account, floor, peak and cushion of all the
+    N scenarios held as vectors and advanced together one time step at a time
+    m, start, floor and drawdown can be scalars or length N vectors (one parameter set per column)
+    Returns the T x N arrays (account, cushion, risky_w, floor) of the values at the end of each step
+    If history is False, only the final account values are returned and the parameters can also be K x 1 columns,
+    which runs K parameter sets over the same N scenarios at once (a K x N result, see cppi_sweep)
+    """
+    import numpy as np
+    n_steps, n_scenarios = risky_r.shape
+    if history:
+        account_history = np.empty((n_steps, n_scenarios))
+        cushion_history = np.empty((n_steps, n_scenarios))
+        risky_w_history = np.empty((n_steps, n_scenarios))
+        floor_history = np.empty((n_steps, n_scenarios))
+    account_value = np.full(n_scenarios, 1.0)*start
+    floor_value = account_value*floor
+    peak = account_value
+    for step in range(n_steps):
+        if drawdown is not None:
+            peak = np.maximum(peak, account_value)
+            floor_value = peak*(1-drawdown)
+        cushion = (account_value - floor_value)/account_value
+        risky_w = np.clip(m*cushion, 0, 1)                      #Between 0% and 100% in the risky asset
+        risky_alloc = account_value*risky_w
+        safe_alloc = account_value*(1-risky_w)
+        account_value = risky_alloc*(1+risky_r[step]) + safe_alloc*(1+safe_r[step])
+        if history:
+            cushion_history[step] = cushion
+            risky_w_history[step] = risky_w
+            account_history[step] = account_value
+            floor_history[step] = floor_value
+    if not history:
+        return account_value
+    return account_history, cushion_history, risky_w_history, floor_history
+
 def run_cppi(risky_r, safe_r=None, m=3, start=1000, floor=0.8, riskfree_rate=0.03, drawdown=None):
     """
-    
+    Runs a CPPI strategy on the risky returns risky_r (a Series, or a T x N DataFrame or ndarray of N scenarios) and
+    the safe returns safe_r (same shape, or one column, riskfree_rate/12 every period if None), with multiplier m and a
+    floor at floor*start, or at (1-drawdown) times the previous peak if drawdown is given
+    The simulation itself runs on NumPy arrays over all the scenarios at once (see cppi_core) and the DataFrames of the
+    result are only built at the end
     """
     import numpy as np
-    #Set up the CPPI Parameters
-    dates = risky_r.index              #Creating and index of dates
-    n_steps = len(dates)               #Length of date gives you the total number i.e. 24 for 2 years worth of monthly data and so on
-    account_value = start              #Initial start value of $1000 assumed
-    floor_value  = start*floor         #Hence, intital floor value will be $800 assuming floor of 0.8
-    peak = start
-    
     if isinstance(risky_r, pd.Series):
-        risky_r = pd.DataFrame(risky_r, columns=["R"])
+        risky_r = risky_r.to_frame("R")
+    elif isinstance(risky_r, np.ndarray):
+        risky_r = pd.DataFrame(risky_r)
         
     if safe_r is None:
-        safe_r = pd.DataFrame().reindex_like(risky_r)
-        safe_r.values[:] = riskfree_rate/12           #Fast way to set all the values to a number
-
+        safe_r = pd.DataFrame(riskfree_rate/12, index=risky_r.index, columns=risky_r.columns)
+    safe = np.asarray(safe_r, dtype=float)
+    safe = np.broadcast_to(safe if safe.ndim == 2 else safe[:, None], risky_r.shape)
 
-    #Some data points we might want to look at constantly across time after the backtest 
-    account_history  = pd.DataFrame().reindex_like(risky_r)     #Portfolio value over time
-    cushion_history  = pd.DataFrame().reindex_like(risky_r)     #History of cushion changing over time 
-    risky_w_history  = pd.DataFrame().reindex_like(risky_r)     #History of weight allocated to risky asset over time
-    floor_history    = pd.DataFrame().reindex_like(risky_r)
-    for step in range(n_steps):
-        if drawdown is not None:
-            peak = np.maximum(peak, account_value)
-            floor_value=peak*(1-drawdown)
-        cushion = (account_value - floor_value)/account_value
-        risky_w = m*cushion
-        risky_w = np.minimum(risky_w, 1)                        #Max Allocation of 100% to Risky Asset
-        risky_w = np.maximum(risky_w, 0)                        #Minimum Allocation of 0% and not negative to Risky Asset
-        safe_w = 1-risky_w
-        risky_alloc = account_value*risky_w                     #Intial Amount Allocated to Risky Asset
-        safe_alloc = account_value*safe_w                       #Intial Amount Allocated to Safe Asset
-    
-        #Update the Account Value for this time step
-        account_value = risky_alloc*(1+risky_r.iloc[step]) + safe_alloc*(1+safe_r.iloc[step])
-    
-        #Save the values so we can look at the history and plot it
-        cushion_history.iloc[step] = cushion
-        risky_w_history.iloc[step] = risky_w
-        account_history.iloc[step] = account_value
-        floor_history.iloc[step]   = floor_value
-    
+    account, cushion, risky_w, floor_value = cppi_core(risky_r.values.astype(float), safe, m, start, floor, drawdown)
+    wrap = lambda x: pd.DataFrame(x, index=risky_r.index, columns=risky_r.columns)
     risky_wealth = start*(1+risky_r).cumprod()
     backtest_result={
-        "Wealth": account_history,
+        "Wealth": wrap(account),
         "Risky Wealth": risky_wealth,
-        "Risk Budget": cushion_history,
-        "Risky Allocation": risky_w_history,
+        "Risk Budget": wrap(cushion),
+        "Risky Allocation": wrap(risky_w),
         "Multiplier": m,
         "Start": start,
-        "Floor": floor_history,
+        "Floor": wrap(floor_value),
         "Risky Return": risky_r,
         "Safe Return": safe_r
                     }
     return backtest_result
 
 
-def summary_stats(r, riskfree_rate=0.03, periods_per_year=12):
-    """
-    Return a DataFrame that contains aggregated summary stats for the returns in the columns of r
-    """
-    wealth_index = (1+r).cumprod()
-    total_rets = ((wealth_index.iloc[-1,:]/wealth_index.iloc[0,:]-1)*100).round(2).astype(str) + '%'
-    ann_r = (r.aggregate(annualized_ret, periods_per_year=periods_per_year)*100).round(2).astype(str) + '%'
-    ann_vol = (r.aggregate(annualized_vol, periods_per_year=periods_per_year)*100).round(2).astype(str) + '%'
-    ann_sr = r.aggregate(sharpe_ratio, rf=riskfree_rate, periods_per_year=periods_per_year).round(2)
-    sortino = r.aggregate(sortino_ratio, rf=riskfree_rate, periods_per_year=periods_per_year).round(2)
-    dd = (r.aggregate(lambda r: drawdown(r).Drawdowns.min())*100).round(2).astype(str) + '%'
-    skew = r.aggregate(skewness).round(2)
-    kurt = r.aggregate(kurtosis).round(2)
-    cf_var5 = (r.aggregate(gaussian_var, modified=True)*100).round(2).astype(str) + '%'
-    hist_cvar5 = (r.aggregate(cvar_historic)*100).round(2).astype(str) + '%'
+def summary_metrics(r, riskfree_rate=0.03, periods_per_year=12, level=5):
+    """
+    Numeric kernel behind summary_stats and summary_stats1: computes every metric of the summary for all the columns of r
+    together on the T x N array (moments from a single demeaning, one drawdown_stats pass for the drawdowns) instead of
+    one r.aggregate pass per metric. Same definitions as annualized_ret, annualized_vol, sharpe_ratio, sortino_ratio,
+    skewness, kurtosis, gaussian_var(modified=True), cvar_historic and drawdown_stats; NaNs are skipped like pandas reductions,
+    except for the Total Return (NaN if the first or last return is missing), the Historic CVaR (NaN if any return is missing)
+    and the Max Drawdown (NaN if every return is missing)
+    Returns a DataFrame of raw (decimal, unrounded) values with one row per column of r
+    """
+    if isinstance(r, pd.Series):
+        r = r.to_frame()
+    x = r.values.astype(float)
+    n_periods = x.shape[0]
+    observed = ~np.isnan(x)
+    complete = observed.all()
+    x_0 = x if complete else np.where(observed, x, 0.0)
+
+    #Moments: one demeaning shared by the volatility, skewness, kurtosis and Cornish-Fisher VaR
+    n_obs, mean, m2, m3, m4 = column_moments(x)
+    sd_pop = np.sqrt(m2)                                    #ddof=0
+    sd = np.sqrt(m2*n_obs/(n_obs - 1))                      #ddof=1 like r.std()
+    skew = m3/sd_pop**3
+    kurt = m4/m2**2
+
+    growth = 1 + x_0
+    total_growth = growth.prod(axis=0)
+    ann_r = total_growth**(periods_per_year/n_periods) - 1
+    rf_per_period = (1+riskfree_rate)**(1/periods_per_year)-1
+    excess_growth = growth - rf_per_period
+    if not complete:
+        excess_growth[~observed] = 1.0
+    ann_excess_r = excess_growth.prod(axis=0)**(periods_per_year/n_periods) - 1
+    del excess_growth
+    ann_vol = sd*np.sqrt(periods_per_year)
+    #Semideviation: population std of the negative returns only
+    neg = np.minimum(x_0, 0.0)
+    n_neg = (neg < 0).sum(axis=0)
+    neg_mean = neg.sum(axis=0)/n_neg
+    semi_dev = np.sqrt(np.maximum(np.einsum("ij,ij->j", neg, neg)/n_neg - neg_mean**2, 0))*np.sqrt(periods_per_year)
+    del neg
+
+    z = norm.ppf(level/100)
+    z_cf = z + (z**2-1)*skew/6 + (z**3-3*z)*(kurt-3)/24 - (2*z**3 - 5*z)*(skew**2)/36
+    cf_var = -(mean + z_cf*sd_pop)
+
+    #Historic CVaR: average of the returns at or below the level-th percentile
+    beyond = x <= (column_percentiles(x, level)[0] if complete else np.nanpercentile(x, level, axis=0))
+    cvar = -np.einsum("ij,ij->j", beyond, x_0)/beyond.sum(axis=0)
+    total_r = total_growth/growth[0] - 1
+    if not complete:
+        cvar[~observed.all(axis=0)] = np.nan
+        total_r[~(observed[0] & observed[-1])] = np.nan
+
+    max_dd = drawdown_stats(r, top_k=1)["Summary"]["Max Drawdown"].to_numpy(copy=True)
+    if not complete:
+        max_dd[~observed.any(axis=0)] = np.nan
+
     return pd.DataFrame({
-        "Total Return": total_rets,
+        "Total Return": total_r,
         "Annualized Return": ann_r,
         "Annualized Vol": ann_vol,
         "Skewness": skew,
         "Kurtosis": kurt,
-        "Cornish-Fisher VaR (5%)": cf_var5,
-        "Historic CVaR (5%)": hist_cvar5,
-        "Sharpe Ratio": ann_sr,
-        "Sortino Ratio": sortino,
-        "Max Drawdown": dd
-    })
+        f"Cornish-Fisher VaR ({level}%)": cf_var,
+        f"Historic CVaR ({level}%)": cvar,
+        "Sharpe Ratio": ann_excess_r/ann_vol,
+        "Sortino Ratio": ann_excess_r/semi_dev,
+        "Max Drawdown": max_dd
+    }, index=r.columns)
+
+def summary_stats(r, riskfree_rate=0.03, periods_per_year=12):
+    """
+    Return a DataFrame that contains aggregated summary stats for the returns in the columns of r
+    """
+    stats = summary_metrics(r, riskfree_rate=riskfree_rate, periods_per_year=periods_per_year)
+    ratios = ["Skewness", "Kurtosis", "Sharpe Ratio", "Sortino Ratio"]
+    formatted = (stats.drop(columns=ratios)*100).round(2).astype(str) + '%'
+    formatted[ratios] = stats[ratios].round(2)
+    return formatted[stats.columns]
 
 def summary_stats1(r, riskfree_rate=0.03, periods_per_year=12):
     """
     Return a DataFrame that contains aggregated summary stats for the returns in the columns of r
     """
-    wealth_index = (1+r).cumprod()
-    total_rets = ((wealth_index.iloc[-1,:]/wealth_index.iloc[0,:]-1)*100).round(2)
-    ann_r = (r.aggregate(annualized_ret, periods_per_year=periods_per_year)*100).round(2)
-    ann_vol = (r.aggregate(annualized_vol, periods_per_year=periods_per_year)*100).round(2)
-    ann_sr = r.aggregate(sharpe_ratio, rf=riskfree_rate, periods_per_year=periods_per_year).round(2)
-    dd = (r.aggregate(lambda r: drawdown(r).Drawdowns.min())*100).round(2)
-    sortino = r.aggregate(sortino_ratio, rf=riskfree_rate, periods_per_year=periods_per_year).round(2)
-    skew = r.aggregate(skewness).round(2)
-    kurt = r.aggregate(kurtosis).round(2)
-    cf_var5 = (r.aggregate(gaussian_var, modified=True)*100).round(2)
-    hist_cvar5 = (r.aggregate(cvar_historic)*100).round(2)
-    return pd.DataFrame({
-        "Total Return": total_rets,
-        "Annualized Return": ann_r,
-        "Annualized Vol": ann_vol,
-        "Skewness": skew,
-        "Kurtosis": kurt,
-        "Cornish-Fisher VaR (5%)": cf_var5,
-        "Historic CVaR (5%)": hist_cvar5,
-        "Sharpe Ratio": ann_sr,
-        "Sortino Ratio": sortino,
-        "Max Drawdown": dd
-    })
+    stats = summary_metrics(r, riskfree_rate=riskfree_rate, periods_per_year=periods_per_year)
+    ratios = ["Skewness", "Kurtosis", "Sharpe Ratio", "Sortino Ratio"]
+    numeric = stats*100
+    numeric[ratios] = stats[ratios]
+    return numeric.round(2)
 
 #Defining a Geometric Brownian Motion(GBM) function:
 import numpy as np
 import pandas as pd
 
-def gbm(n_years=10, n_scenarios=3, steps_per_year=12, mu=0.07, sigma=0.15, s_0=100.0, prices=True):
+def gbm_shocks(n_steps, n_scenarios, variance_reduction, rng=None):
+    """
+    n_steps x n_scenarios standard normal shocks for gbm drawn with a variance reduction technique:
+    "antithetic": half the scenarios are the mirror image -z of the other half
+    "moment_matching": the shocks of each time step are recentred and rescaled to a sample mean of 0 and variance of 1
+    "sobol": scrambled Sobol points, one dimension per time step, mapped through the normal quantile function
+    (the Sobol sequence is best balanced when n_scenarios is a power of 2)
+    The first row is not used by gbm, which sets the first return to 0
+    """
+    random = np.random if rng is None else rng
+    if variance_reduction == "antithetic":
+        half = random.standard_normal(size=(n_steps, (n_scenarios + 1)//2))
+        return np.hstack([half, -half])[:, :n_scenarios]
+    elif variance_reduction == "moment_matching":
+        if n_scenarios < 2:
+            raise ValueError("moment_matching needs at least 2 scenarios")
+        shocks = random.standard_normal(size=(n_steps, n_scenarios))
+        shocks -= shocks.mean(axis=1, keepdims=True)
+        shocks /= shocks.std(axis=1, keepdims=True)
+        return shocks
+    elif variance_reduction == "sobol":
+        from scipy.stats import qmc
+        #Scrambling needs its own seed: take it from rng, or from the global state so np.random.seed still replays the run
+        seed = rng if rng is not None else np.random.randint(2**31)
+        points = qmc.Sobol(d=max(n_steps - 1, 1), scramble=True, seed=seed).random(n_scenarios)
+        shocks = np.zeros((n_steps, n_scenarios))
+        shocks[1:] = norm.ppf(points.T[:n_steps - 1])
+        return shocks
+    raise ValueError(f"variance_reduction must be one of: None, antithetic, moment_matching, sobol; got {variance_reduction!r}")
+
+def gbm(n_years=10, n_scenarios=3, steps_per_year=12, mu=0.07, sigma=0.15, s_0=100.0, prices=True, rng=None, variance_reduction=None):
     """
     Generates the Evolution of Asset Prices using a Geometric Brownian Motion Model
     Input Paramters: No. of years
@@ -561,17 +1272,210 @@ def gbm(n_years=10, n_scenarios=3, steps_per_year=12, mu=0.07, sigma=0.15, s_0=1
                      Volatility
                      Steps per year (eg. 12 for monthly)
                      Initial Asset Price(S0)
+                     rng: numpy Generator to draw from (e.g. from a SimulationContext), the global np.random state if None
+                     variance_reduction: None for plain sampling, or "antithetic", "moment_matching" or "sobol" (see gbm_shocks)
     """
     dt=1/steps_per_year
     n_steps= int(n_years*steps_per_year) + 1
     # the standard way ...
     # rets_plus_1 = np.random.normal(loc=mu*dt+1, scale=sigma*np.sqrt(dt), size=(n_steps, n_scenarios))
     # without discretization error ...
-    rets_plus_1 = np.random.normal(loc=(1 + mu)**dt, scale= (sigma*np.sqrt(dt)), size=(n_steps, n_scenarios))
+    if variance_reduction is None:
+        random = np.random if rng is None else rng
+        rets_plus_1 = random.normal(loc=(1 + mu)**dt, scale= (sigma*np.sqrt(dt)), size=(n_steps, n_scenarios))
+    else:
+        rets_plus_1 = gbm_shocks(n_steps, n_scenarios, variance_reduction, rng)
+        rets_plus_1 *= sigma*np.sqrt(dt)
+        rets_plus_1 += (1 + mu)**dt
     rets_plus_1[0] = 1                      #Making the First Random Return 0, so that first row of each scenario is the saw i.e. 100
-    rets = pd.DataFrame(rets_plus_1)
-    ret_val= s_0*(rets).cumprod() if prices else rets_plus_1-1
-    return ret_val
+    if not prices:
+        return rets_plus_1-1
+    np.cumprod(rets_plus_1, axis=0, out=rets_plus_1)    #Compound in place rather than through a DataFrame copy
+    rets_plus_1 *= s_0
+    return pd.DataFrame(rets_plus_1)
+
+def gbm_chunks(n_years=10, n_scenarios=3, steps_per_year=12, mu=0.07, sigma=0.15, s_0=100.0, prices=True, chunk_size=10000, rng=None):
+    """
+    Streaming version of gbm: yields the n_scenarios paths as T x chunk_size ndarrays (the last block may be narrower),
+    so only one block is ever held in memory however many scenarios are simulated
+    Feed the blocks of returns (prices=False) to terminal_values/terminal_stats, or write them to disk with gbm_memmap
+    """
+    dt = 1/steps_per_year
+    n_steps = int(n_years*steps_per_year) + 1
+    random = np.random if rng is None else rng
+    for first in range(0, n_scenarios, chunk_size):
+        block = random.normal(loc=(1 + mu)**dt, scale=(sigma*np.sqrt(dt)), size=(n_steps, min(chunk_size, n_scenarios - first)))
+        block[0] = 1
+        if prices:
+            np.cumprod(block, axis=0, out=block)
+            block *= s_0
+        else:
+            block -= 1
+        yield block
+
+def gbm_memmap(filename, n_years=10, n_scenarios=3, steps_per_year=12, mu=0.07, sigma=0.15, s_0=100.0, prices=True, chunk_size=10000, rng=None):
+    """
+    Simulates gbm paths block by block (see gbm_chunks) into a T x n_scenarios .npy file memory-mapped at filename,
+    and returns the memory-mapped array, which can be reopened later with np.load(filename, mmap_mode="r")
+    """
+    n_steps = int(n_years*steps_per_year) + 1
+    out = np.lib.format.open_memmap(filename, mode="w+", dtype=float, shape=(n_steps, n_scenarios))
+    first = 0
+    for block in gbm_chunks(n_years, n_scenarios, steps_per_year, mu, sigma, s_0, prices, chunk_size, rng):
+        out[:, first:first + block.shape[1]] = block
+        first += block.shape[1]
+    out.flush()
+    return out
+
+_cholesky_cache = {}
+
+def cholesky_factor(cov):
+    """
+    Lower triangular Cholesky factor of the covariance matrix cov, cached on the matrix contents so that repeated
+    simulations with the same covariance (e.g. one per chunk in simulate) factorize it only once
+    """
+    cov = np.ascontiguousarray(cov, dtype=float)
+    key = (cov.shape, cov.tobytes())
+    if key not in _cholesky_cache:
+        if len(_cholesky_cache) >= 32:
+            _cholesky_cache.clear()
+        _cholesky_cache[key] = np.linalg.cholesky(cov)
+    return _cholesky_cache[key]
+
+def gbm_multi(n_years=10, n_scenarios=3, steps_per_year=12, mu=0.07, cov=0.0225, s_0=100.0, prices=True, rng=None, dtype=float):
+    """
+    Correlated multi-asset version of gbm: mu is the vector of annual returns and cov the annualized covariance matrix
+    of the N assets (a scalar for a single asset), and the gross returns of each period are (1+mu)**dt plus the
+    Cholesky factor of cov*dt times independent standard normal shocks, drawn for all the assets at once
+    Returns a T x n_scenarios x N array of dtype (e.g. np.float32 to halve the memory) of prices, or of returns if
+    prices=False; r[:, :, i] is the T x n_scenarios panel of asset i, ready for bt_mix, the allocators and terminal_stats
+    """
+    mu = np.atleast_1d(np.asarray(mu, dtype=float))
+    cov = np.atleast_2d(np.asarray(cov, dtype=float))
+    n_assets = cov.shape[0]
+    mu = np.broadcast_to(mu, (n_assets,))
+    dt = 1/steps_per_year
+    n_steps = int(n_years*steps_per_year) + 1
+    random = np.random if rng is None else rng
+    shocks = random.standard_normal(size=(n_steps, n_scenarios, n_assets))
+    rets_plus_1 = shocks @ (cholesky_factor(cov)*np.sqrt(dt)).T
+    del shocks
+    rets_plus_1 += (1 + mu)**dt
+    rets_plus_1[0] = 1                      #First return of every path is 0, like gbm
+    if not prices:
+        rets_plus_1 -= 1
+        return rets_plus_1.astype(dtype, copy=False)
+    np.cumprod(rets_plus_1, axis=0, out=rets_plus_1)
+    rets_plus_1 *= s_0
+    return rets_plus_1.astype(dtype, copy=False)
+
+class SimulationContext:
+    """
+    Reproducible random streams for simulations split into chunks of chunk_size scenarios
+    Chunk k always draws from the Generator of the k-th child of SeedSequence(seed), whichever process runs it, so
+    the streams are statistically independent and the scenarios come out the same for any number of workers
+    seed=None takes fresh entropy from the OS, read it back from .entropy to replay the run
+    """
+    def __init__(self, seed=None, chunk_size=10000):
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.entropy = self.seed_sequence.entropy
+        self.chunk_size = chunk_size
+
+    def seed(self, chunk):
+        """
+        SeedSequence of the chunk, the same as self.seed_sequence.spawn(chunk + 1)[chunk] without mutating the parent
+        """
+        return np.random.SeedSequence(self.entropy, spawn_key=self.seed_sequence.spawn_key + (chunk,),
+                                      pool_size=self.seed_sequence.pool_size)
+
+    def generator(self, chunk):
+        return np.random.default_rng(self.seed(chunk))
+
+    def chunks(self, n_scenarios):
+        """
+        Sizes of the successive chunks covering n_scenarios
+        """
+        return [min(self.chunk_size, n_scenarios - first) for first in range(0, n_scenarios, self.chunk_size)]
+
+def concat_scenarios(parts, relabel=False):
+    """
+    Joins the results of a simulation or allocator run on consecutive chunks of scenarios along the scenario axis
+    DataFrames (renumbered 0..N-1 if relabel), ndarrays, and tuples or dicts of them are joined item by item, anything
+    else (e.g. the "Multiplier" of run_cppi) is taken from the first chunk
+    """
+    first = parts[0]
+    if isinstance(first, pd.DataFrame):
+        joined = pd.concat(parts, axis=1)
+        if relabel:
+            joined.columns = range(joined.shape[1])
+        return joined
+    elif isinstance(first, np.ndarray) and first.ndim >= 2:
+        return np.concatenate(parts, axis=1)
+    elif isinstance(first, tuple):
+        return tuple(concat_scenarios(list(items), relabel) for items in zip(*parts))
+    elif isinstance(first, dict):
+        return {key: concat_scenarios([part[key] for part in parts], relabel) for key in first}
+    return first
+
+def simulation_chunk(task):
+    """
+    Runs one chunk of simulate in a worker process
+    """
+    simulator, n_scenarios, seed, kwargs = task
+    return simulator(n_scenarios=n_scenarios, rng=np.random.default_rng(seed), **kwargs)
+
+def scenario_chunk(task):
+    """
+    Runs one chunk of run_scenarios in a worker process
+    """
+    func, panels, kwargs = task
+    return func(*panels, **kwargs)
+
+def map_chunks(worker, tasks, n_jobs=None):
+    """
+    Maps worker over the tasks in order, on n_jobs processes (-1 for all cores) or serially if n_jobs is None or 1
+    """
+    if n_jobs is None or n_jobs == 1 or len(tasks) < 2:
+        return [worker(task) for task in tasks]
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks))) as pool:
+        return list(pool.map(worker, tasks))
+
+def simulate(simulator, n_scenarios, context, n_jobs=None, **kwargs):
+    """
+    Runs a simulator taking n_scenarios and rng (gbm, cir, gbm_multi...) over n_scenarios split into the chunks of
+    context, each chunk with its own random stream, spread over n_jobs worker processes
+    context is a SimulationContext, or an int seed for one with the default chunk_size. It is required so the run can
+    always be replayed: for fresh entropy pass SimulationContext() and keep it (its .entropy is the seed)
+    The result is the simulator's output for all the scenarios (scenarios numbered 0..N-1) and is bit for bit the same
+    for any n_jobs given the same context
+    """
+    if isinstance(context, (int, np.integer)):
+        context = SimulationContext(context)
+    elif not isinstance(context, SimulationContext):
+        raise TypeError("context must be a SimulationContext or an int seed")
+    tasks = [(simulator, size, context.seed(chunk), kwargs) for chunk, size in enumerate(context.chunks(n_scenarios))]
+    return concat_scenarios(map_chunks(simulation_chunk, tasks, n_jobs), relabel=True)
+
+def run_scenarios(func, *panels, n_jobs=None, chunk_size=1000, **kwargs):
+    """
+    Runs func (run_cppi, floor_allocator, drawdown_allocator...) on chunk_size scenario columns of the T x N panels at
+    a time, over n_jobs worker processes, and joins the results along the scenario axis. Keyword arguments that are
+    DataFrames or ndarrays of the same shape as the first panel (e.g. the zc_prices of floor_allocator) are split too
+    Each scenario only depends on its own column so the result does not depend on n_jobs or chunk_size
+    """
+    n_scenarios = panels[0].shape[1]
+    split = {key for key, value in kwargs.items() if isinstance(value, (pd.DataFrame, np.ndarray)) and value.shape == panels[0].shape}
+
+    def columns(panel, first):
+        return panel.iloc[:, first:first + chunk_size] if isinstance(panel, pd.DataFrame) else panel[:, first:first + chunk_size]
+
+    tasks = [(func, [columns(panel, first) for panel in panels],
+              {key: columns(value, first) if key in split else value for key, value in kwargs.items()})
+             for first in range(0, n_scenarios, chunk_size)]
+    return concat_scenarios(map_chunks(scenario_chunk, tasks, n_jobs))
   
     
 #Week 4: Asset-Liability Management
@@ -624,45 +1528,55 @@ def ann_to_inst(r):
 
 #Updated CIR Model that generates the zero coupon bond prices at the generated implied rates:
 import math
-def cir(n_years = 10, n_scenarios=1, a=0.05, b=0.03, sigma=0.05, steps_per_year=12, r_0=None):
+def cir_bond_coefficients(a, b, sigma, ttm):
+    """
+    Coefficients A(ttm) and B(ttm) of the CIR zero coupon bond price P = A*exp(-B*r) for an array of times to maturity
+    (in years), so the prices of any number of rates and maturities come out of one broadcast
+    """
+    h = math.sqrt(a**2 + 2*sigma**2)
+    ttm = np.asarray(ttm, dtype=float)
+    growth = np.exp(h*ttm) - 1
+    denominator = 2*h + (h+a)*growth
+    _A = ((2*h*np.exp((h+a)*ttm/2))/denominator)**(2*a*b/sigma**2)
+    _B = 2*growth/denominator
+    return _A, _B
+
+def cir(n_years = 10, n_scenarios=1, a=0.05, b=0.03, sigma=0.05, steps_per_year=12, r_0=None, rng=None, dtype=float, maturities=None):
     """
     Generate random interest rate evolution over time using the CIR model
     b and r_0 are assumed to be the annualized rates, not the short rate
     and the returned values are the annualized rates as well
+    rng is the numpy Generator to draw the shocks from, the global np.random state if None
+    Returns the rates and the prices of the zero coupon bond maturing at n_years as T x N DataFrames of dtype
+    (e.g. np.float32, the simulation itself runs in float64). If maturities is a list of maturities in years from
+    today, prices is instead a dict maturity -> T x N DataFrame of the prices of the zero coupon bonds maturing then
+    (worth 1 from their maturity on), all priced off the same rate paths
     """
     if r_0 is None: r_0 = b 
     r_0 = ann_to_inst(r_0)
     dt = 1/steps_per_year
     num_steps = int(n_years*steps_per_year) + 1 # because n_years might be a float
     
-    shock = np.random.normal(0, scale=np.sqrt(dt), size=(num_steps, n_scenarios))
+    random = np.random if rng is None else rng
+    shock = random.normal(0, scale=np.sqrt(dt), size=(num_steps, n_scenarios))
     rates = np.empty_like(shock)
     rates[0] = r_0
-
-    ## For Price Generation
-    h = math.sqrt(a**2 + 2*sigma**2)
-    prices = np.empty_like(shock)
-    ####
-
-    def price(ttm, r):
-        _A = ((2*h*math.exp((h+a)*ttm/2))/(2*h+(h+a)*(math.exp(h*ttm)-1)))**(2*a*b/sigma**2)
-        _B = (2*(math.exp(h*ttm)-1))/(2*h + (h+a)*(math.exp(h*ttm)-1))
-        _P = _A*np.exp(-_B*r)
-        return _P
-    prices[0] = price(n_years, r_0)
-    ####
-    
     for step in range(1, num_steps):
         r_t = rates[step-1]
         d_r_t = a*(b-r_t)*dt + sigma*np.sqrt(r_t)*shock[step]
         rates[step] = abs(r_t + d_r_t)
-        # generate prices at time t as well ...
-        prices[step] = price(n_years-step*dt, rates[step])
-
-    rates = pd.DataFrame(data=inst_to_ann(rates), index=range(num_steps))
-    ### for prices
-    prices = pd.DataFrame(data=prices, index=range(num_steps))
-    ###
+    del shock
+
+    #A and B only depend on the time to maturity of each step: compute them once and price every step and scenario together
+    def prices_at(maturity):
+        _A, _B = cir_bond_coefficients(a, b, sigma, np.maximum(maturity - np.arange(num_steps)*dt, 0))
+        prices = np.multiply(-_B[:, None], rates)
+        np.exp(prices, out=prices)
+        prices *= _A[:, None]
+        return pd.DataFrame(data=prices.astype(dtype, copy=False), index=range(num_steps))
+
+    prices = prices_at(n_years) if maturities is None else {maturity: prices_at(maturity) for maturity in maturities}
+    rates = pd.DataFrame(data=inst_to_ann(rates).astype(dtype, copy=False), index=range(num_steps))
     return rates, prices
            
 #Bond Price Calculation using the First Principles i.e. Cash Flow Discounting Method
@@ -754,6 +1668,7 @@ def bt_mix(r1, r2, allocator, **kwargs):
     allocator is a function that takes two sets of returns and allocator specific parameters, and produces
     an allocation to the first portfolio (the rest of the money is invested in the GHP) as a T x 1 DataFrame
     Returns a T x N DataFrame of the resulting N portfolio scenarios
+    r1 and r2 can also be T x N ndarrays (e.g. two assets r[:, :, i] of gbm_multi), in which case so is the result
     """
     if not r1.shape == r2.shape:
         raise ValueError("r1 and r2 need to have the same shape")
@@ -769,40 +1684,93 @@ def fixedmix_allocator(r1, r2, w1, **kwargs):
     PSP and GHP are T x N DataFrames that represent the returns of the PSP and GHP such that:
     each column is a scenario
     each row is the price for a timestep
-    Returns an T x N DataFrame of PSP Weights
+    Returns an T x N DataFrame of PSP Weights (a T x N ndarray if r1 is an ndarray)
     """
+    if isinstance(r1, np.ndarray):
+        return np.full(r1.shape, w1, dtype=float)
     return pd.DataFrame(data=w1, index=r1.index, columns=r1.columns)
 
+def return_blocks(rets, chunk_size=10000):
+    """
+    Yields T x n blocks of returns (ndarrays) from a T x N DataFrame, a T x N ndarray or memory-mapped array (sliced
+    chunk_size columns at a time) or any iterable of those, e.g. gbm_chunks(..., prices=False)
+    """
+    if isinstance(rets, pd.Series):
+        yield rets.values[:, None]
+    elif isinstance(rets, pd.DataFrame):
+        yield rets.values
+    elif isinstance(rets, np.ndarray):
+        rets = rets if rets.ndim == 2 else rets[:, None]
+        for first in range(0, rets.shape[1], chunk_size):
+            yield rets[:, first:first + chunk_size]
+    else:
+        for block in rets:
+            yield from return_blocks(block, chunk_size)
+
 def terminal_values(rets):
     """
     Computes the terminal values from a set of returns supplied as a T x N DataFrame
     Return a Series of length N indexed by the columns of rets
-    """
-    return (rets+1).prod()
+    rets can also be a T x N ndarray/memmap or an iterable of blocks of scenarios (see return_blocks), which are
+    compounded one block at a time and give an ndarray of length N
+    """
+    if isinstance(rets, (pd.Series, pd.DataFrame)):
+        return (rets+1).prod()
+    return np.concatenate([(block+1).prod(axis=0) for block in return_blocks(rets)])
+
+class TerminalWealthStats:
+    """
+    Online aggregator for terminal_stats: update() it with the terminal wealth of any number of batches of scenarios
+    and summary() gives the statistics of all of them, from a handful of running totals (the mean and variance of
+    each batch are merged with Chan's parallel update)
+    """
+    def __init__(self, floor=0.8, cap=np.inf):
+        self.floor, self.cap = floor, cap
+        self.count, self.mean, self.m2 = 0, 0.0, 0.0
+        self.n_breach, self.shortfall, self.n_reach, self.surplus = 0, 0.0, 0, 0.0
+
+    def update(self, terminal_wealth):
+        wealth = np.asarray(terminal_wealth, dtype=float).ravel()
+        n = wealth.size
+        if n == 0:
+            return self
+        mean = wealth.mean()
+        total = self.count + n
+        delta = mean - self.mean
+        self.m2 += ((wealth - mean)**2).sum() + delta**2*self.count*n/total
+        self.mean += delta*n/total
+        self.count = total
+        breach = wealth < self.floor
+        reach = wealth >= self.floor
+        self.n_breach += int(breach.sum())
+        self.shortfall += (self.floor - wealth[breach]).sum()
+        self.n_reach += int(reach.sum())
+        self.surplus += (self.cap - wealth[reach]).sum()
+        return self
+
+    def summary(self, name="Stats"):
+        return pd.DataFrame.from_dict({
+            "Mean": self.mean if self.count > 0 else np.nan,
+            "Volatility" : np.sqrt(self.m2/(self.count - 1)) if self.count > 1 else np.nan,
+            "Probability of Breach": self.n_breach/self.count if self.n_breach > 0 else np.nan,
+            "Expected Shortfall": self.shortfall/self.n_breach if self.n_breach > 0 else np.nan,
+            "Probability of Reach": self.n_reach/self.count if self.n_reach > 0 else np.nan,
+            "Expected Surplus": self.surplus/self.n_reach if self.n_reach > 0 else np.nan
+        }, orient="index", columns=[name])
 
 def terminal_stats(rets, floor=0.8, cap=np.inf, name="Stats"):
     """
     Produce Summary Statistics on the terminal values per invested dollar
     across a range of N scenarios
     rets is a T x N DataFrame of returns, where T is the time-step (we assume rets is sorted by time)
+    or a T x N ndarray/memmap or an iterable of blocks of scenarios such as gbm_chunks(..., prices=False),
+    aggregated one block at a time with TerminalWealthStats so N is only bounded by time, not memory
     Returns a 1 column DataFrame of Summary Stats indexed by the stat name 
     """
-    terminal_wealth = (rets+1).prod()
-    breach = terminal_wealth < floor
-    reach = terminal_wealth >= floor
-    p_breach = breach.mean() if breach.sum() > 0 else np.nan
-    p_reach = breach.mean() if reach.sum() > 0 else np.nan
-    e_short = (floor-terminal_wealth[breach]).mean() if breach.sum() > 0 else np.nan
-    e_surplus = (cap-terminal_wealth[reach]).mean() if reach.sum() > 0 else np.nan
-    sum_stats = pd.DataFrame.from_dict({
-        "Mean": terminal_wealth.mean(),
-        "Volatility" : terminal_wealth.std(),
-        "Probability of Breach": p_breach,
-        "Expected Shortfall":e_short,
-        "Probability of Reach": p_reach,
-        "Expected Surplus": e_surplus
-    }, orient="index", columns=[name])
-    return sum_stats
+    stats = TerminalWealthStats(floor, cap)
+    for block in return_blocks(rets):
+        stats.update((block+1).prod(axis=0))
+    return stats.summary(name)
 
 def glidepath_allocator(r1, r2, start_glide=1, end_glide=1):
     """
@@ -811,6 +1779,8 @@ def glidepath_allocator(r1, r2, start_glide=1, end_glide=1):
     """
     n_points = r1.shape[0]
     n_cols = r1.shape[1]
+    if isinstance(r1, np.ndarray):
+        return np.tile(np.linspace(start_glide, end_glide, num=n_points)[:, None], (1, n_cols))
     path = pd.Series(np.linspace(start_glide, end_glide, num=n_points))
     #We need N number of paths depending the number of columns of returns i.e. No of Scenarios
     paths = pd.concat([path]*n_cols, axis=1)    #Replicate path in list form [path], by multiplying it with the number of scenarios and place them side by side in columns hence axis=1
@@ -819,6 +1789,42 @@ def glidepath_allocator(r1, r2, start_glide=1, end_glide=1):
     return paths 
 
 
+def risk_budget_weights(psp_r, ghp_r, m=3, floor=None, zc_prices=None, maxdd=None, history=True):
+    """
+    NumPy core of floor_allocator and drawdown_allocator: CPPI-style risk budgeting between the PSP and the GHP on
+    T x N float arrays, advancing the account (and peak) vectors of all the scenarios one row at a time
+    The floor at each step is floor times the row of zc_prices if maxdd is None, else (1-maxdd) times the previous peak
+    m, floor and maxdd can be scalars or length N vectors (one parameter set per column)
+    Returns the T x N float64 array of PSP weights
+    If history is False, only the final account values (the terminal wealth of bt_mix) are returned and the
+    parameters can also be K x 1 columns, to run K parameter sets over the same scenarios at once (see allocator_sweep)
+    """
+    import numpy as np
+    psp_r = np.ascontiguousarray(psp_r, dtype=float)       #Rows are read one at a time, keep them contiguous
+    ghp_r = np.ascontiguousarray(ghp_r, dtype=float)
+    if maxdd is None:
+        zc_prices = np.ascontiguousarray(zc_prices, dtype=float)
+    n_steps, n_scenarios = psp_r.shape
+    account_value = np.ones(n_scenarios)
+    peak_value = np.ones(n_scenarios)
+    if history:
+        w_history = np.empty((n_steps, n_scenarios))
+    for step in range(n_steps):
+        floor_value = floor*zc_prices[step] if maxdd is None else (1-maxdd)*peak_value
+        cushion = (account_value - floor_value)/account_value
+        psp_w = np.clip(m*cushion, 0, 1) # same as applying min and max
+        psp_alloc = account_value*psp_w
+        ghp_alloc = account_value*(1-psp_w)
+        # recompute the new account value and prev peak at the end of this step
+        account_value = psp_alloc*(1+psp_r[step]) + ghp_alloc*(1+ghp_r[step])
+        if maxdd is not None:
+            peak_value = np.maximum(peak_value, account_value)
+        if history:
+            w_history[step] = psp_w
+    if not history:
+        return account_value
+    return w_history
+
 def floor_allocator(psp_r, ghp_r, floor, zc_prices, m=3):
     """
     Allocate between PSP and GHP with the goal to provide exposure to the upside
@@ -826,23 +1832,14 @@ def floor_allocator(psp_r, ghp_r, floor, zc_prices, m=3):
     Uses a CPPI-style dynamic risk budgeting algorithm by investing a multiple
     of the cushion in the PSP
     Returns a DataFrame with the same shape as the psp/ghp representing the weights in the PSP
+    (a float64 ndarray if psp_r is an ndarray), computed on arrays by risk_budget_weights
     """
     if zc_prices.shape != psp_r.shape:
         raise ValueError("PSP and ZC Prices must have the same shape")
-    n_steps, n_scenarios = psp_r.shape
-    account_value = np.repeat(1, n_scenarios)
-    floor_value = np.repeat(1, n_scenarios)
-    w_history = pd.DataFrame(index=psp_r.index, columns=psp_r.columns)
-    for step in range(n_steps):
-        floor_value = floor*zc_prices.iloc[step] ## PV of Floor assuming today's rates and flat YC
-        cushion = (account_value - floor_value)/account_value
-        psp_w = (m*cushion).clip(0, 1) # same as applying min and max
-        ghp_w = 1-psp_w
-        psp_alloc = account_value*psp_w
-        ghp_alloc = account_value*ghp_w
-        # recompute the new account value at the end of this step
-        account_value = psp_alloc*(1+psp_r.iloc[step]) + ghp_alloc*(1+ghp_r.iloc[step])
-        w_history.iloc[step] = psp_w
+    ## The floor of each step is the PV of the floor assuming today's rates and flat YC i.e. floor*zc_prices
+    w_history = risk_budget_weights(psp_r, ghp_r, m, floor=floor, zc_prices=zc_prices)
+    if isinstance(psp_r, pd.DataFrame):
+        return pd.DataFrame(w_history, index=psp_r.index, columns=psp_r.columns)
     return w_history
 
 def drawdown_allocator(psp_r, ghp_r, maxdd, m=3):
@@ -852,25 +1849,93 @@ def drawdown_allocator(psp_r, ghp_r, maxdd, m=3):
     Uses a CPPI-style dynamic risk budgeting algorithm by investing a multiple
     of the cushion in the PSP
     Returns a DataFrame with the same shape as the psp/ghp representing the weights in the PSP
+    (a float64 ndarray if psp_r is an ndarray), computed on arrays by risk_budget_weights
     """
-    n_steps, n_scenarios = psp_r.shape
-    account_value = np.repeat(1, n_scenarios)
-    floor_value = np.repeat(1, n_scenarios)
-    peak_value = np.repeat(1, n_scenarios)
-    w_history = pd.DataFrame(index=psp_r.index, columns=psp_r.columns)
-    for step in range(n_steps):
-        floor_value = (1-maxdd)*peak_value ### Floor is based on Prev Peak
-        cushion = (account_value - floor_value)/account_value
-        psp_w = (m*cushion).clip(0, 1) # same as applying min and max
-        ghp_w = 1-psp_w
-        psp_alloc = account_value*psp_w
-        ghp_alloc = account_value*ghp_w
-        # recompute the new account value and prev peak at the end of this step
-        account_value = psp_alloc*(1+psp_r.iloc[step]) + ghp_alloc*(1+ghp_r.iloc[step])
-        peak_value = np.maximum(peak_value, account_value)
-        w_history.iloc[step] = psp_w
+    w_history = risk_budget_weights(psp_r, ghp_r, m, maxdd=maxdd)
+    if isinstance(psp_r, pd.DataFrame):
+        return pd.DataFrame(w_history, index=psp_r.index, columns=psp_r.columns)
     return w_history
 
+def sweep_stats(grid, terminal_wealth, breach_floors, cap):
+    """
+    Tidy table of the parameter grid (a DataFrame, one row per combination) followed by the terminal_stats of each
+    row of terminal_wealth (K combinations x N scenarios, per invested dollar) against its breach floor
+    """
+    stats = [TerminalWealthStats(breach_floor, cap).update(wealth).summary().iloc[:, 0]
+             for wealth, breach_floor in zip(terminal_wealth, breach_floors)]
+    return pd.concat([grid.reset_index(drop=True), pd.DataFrame(stats).reset_index(drop=True)], axis=1)
+
+def sweep_chunks(n_combinations, n_scenarios, chunk_size):
+    """
+    Slices of the parameter grid holding at most chunk_size (combination, scenario) pairs (at least one combination)
+    """
+    step = max(1, chunk_size//max(n_scenarios, 1))
+    return [slice(first, first + step) for first in range(0, n_combinations, step)]
+
+def cppi_sweep(risky_r, safe_r=None, m=(3,), floor=(0.8,), drawdown=None, start=1000, riskfree_rate=0.03,
+               breach_floor=None, cap=np.inf, chunk_size=1000000):
+    """
+    Runs run_cppi for every combination of the multipliers m, floors and (if given) max drawdowns on the same T x N
+    scenario panel of risky returns (safe_r as in run_cppi): the grid is an extra leading axis of cppi_core, so all the
+    combinations of a chunk of at most chunk_size (combination, scenario) pairs advance together over the panel
+    With drawdown the floor is reset to peak*(1-drawdown) at every step, so floor plays no part and is left out of the grid
+    Returns a tidy DataFrame with one row per combination: m and floor (or drawdown) and the terminal_stats of the
+    terminal wealth per invested dollar, breaches being measured against breach_floor, or the combination's floor
+    (1-drawdown for the drawdown variant) if None
+    """
+    risky = np.asarray(risky_r, dtype=float)
+    risky = np.ascontiguousarray(risky if risky.ndim == 2 else risky[:, None])
+    safe = np.full(risky.shape, riskfree_rate/12) if safe_r is None else np.asarray(safe_r, dtype=float)
+    safe = np.broadcast_to(safe if safe.ndim == 2 else safe[:, None], risky.shape)
+    names = ["m", "floor"] if drawdown is None else ["m", "drawdown"]
+    values = [m, floor] if drawdown is None else [m, drawdown]
+    grid = pd.MultiIndex.from_product(values, names=names).to_frame(index=False)
+    tables = []
+    for rows in sweep_chunks(len(grid), risky.shape[1], chunk_size):
+        params = grid.iloc[rows]
+        column = lambda name: params[name].values.astype(float)[:, None]
+        if drawdown is None:
+            wealth = cppi_core(risky, safe, column("m"), start, column("floor"), history=False)/start
+        else:
+            wealth = cppi_core(risky, safe, column("m"), start, 1 - column("drawdown"), column("drawdown"), history=False)/start
+        if breach_floor is not None:
+            breach_floors = np.full(len(params), breach_floor)
+        else:
+            breach_floors = params["floor"].values if drawdown is None else 1 - params["drawdown"].values
+        tables.append(sweep_stats(params, wealth, breach_floors, cap))
+    return pd.concat(tables, ignore_index=True)
+
+def allocator_sweep(psp_r, ghp_r, m=(3,), maxdd=None, floor=None, zc_prices=None, breach_floor=None, cap=np.inf,
+                    chunk_size=1000000):
+    """
+    Runs bt_mix with drawdown_allocator for every combination of the multipliers m and max drawdowns maxdd, or with
+    floor_allocator for every combination of m and floor (with zc_prices), on the same T x N PSP/GHP scenario panels:
+    the grid is an extra leading axis of risk_budget_weights, so all the combinations of a chunk of at most chunk_size
+    (combination, scenario) pairs advance together
+    Returns a tidy DataFrame with one row per combination: m, maxdd or floor and the terminal_stats of the mix,
+    breaches being measured against breach_floor, or 1-maxdd / the floor of the combination if None
+    """
+    if (maxdd is None) == (floor is None):
+        raise ValueError("Give either maxdd (drawdown_allocator) or floor and zc_prices (floor_allocator)")
+    if floor is not None and (zc_prices is None or zc_prices.shape != psp_r.shape):
+        raise ValueError("PSP and ZC Prices must have the same shape")
+    name = "maxdd" if floor is None else "floor"
+    grid = pd.MultiIndex.from_product([m, maxdd if floor is None else floor], names=["m", name]).to_frame(index=False)
+    tables = []
+    for rows in sweep_chunks(len(grid), psp_r.shape[1], chunk_size):
+        params = grid.iloc[rows]
+        column = lambda name: params[name].values.astype(float)[:, None]
+        if floor is None:
+            wealth = risk_budget_weights(psp_r, ghp_r, column("m"), maxdd=column("maxdd"), history=False)
+        else:
+            wealth = risk_budget_weights(psp_r, ghp_r, column("m"), floor=column("floor"), zc_prices=zc_prices, history=False)
+        if breach_floor is not None:
+            breach_floors = np.full(len(params), breach_floor)
+        else:
+            breach_floors = 1 - params["maxdd"].values if floor is None else params["floor"].values
+        tables.append(sweep_stats(params, wealth, breach_floors, cap))
+    return pd.concat(tables, ignore_index=True)
+
 ##### ##### ##### ##### #####  ##### ##### ##### ##### ##### ##### COURSE 2 ###### ##### ##### ##### ##### ##### ##### ##### ##### ##### ##### ##### 
 def regress(dependent_variable, explanatory_variables, alpha=True):
     """
@@ -901,6 +1966,15 @@ def portfolio_tracking_error(weights, ref_r, bb_r):
     """
     return tracking_error(ref_r, (weights*bb_r).sum(axis=1))
 
+def portfolio_tracking_error_gradient(weights, ref_r, bb_r):
+    """
+    Returns the gradient of portfolio_tracking_error with respect to the weights
+    i.e. -bb_r'(ref_r - bb_r @ w)/tracking error, missing returns are skipped just like the sums above
+    """
+    bb = np.nan_to_num(np.asarray(bb_r, dtype=float))
+    residual = np.nan_to_num(np.asarray(ref_r, dtype=float) - bb @ weights)
+    return -(bb.T @ residual)/np.sqrt(residual @ residual)
+
 from scipy.optimize import minimize
 def style_analysis(dependant_variable, explanatory_variables):
     """
@@ -911,10 +1985,12 @@ def style_analysis(dependant_variable, explanatory_variables):
     init_guess = np.repeat(1/n, n)                       #Inital guess of weightage is equal weight to each factor 
     bounds = ((0.00, 1.00),)*n                           #Min and max weights of 0% and 100% to each factor (n) hence multipled by n to get bounds for factors
     constraint_1 = {'type': 'eq',
-                    'fun': lambda weights: np.sum(weights) - 1}           #Constraint: Weights should sum to 1, 'eq' means equality that the equation = 0
+                    'fun': lambda weights: np.sum(weights) - 1,           #Constraint: Weights should sum to 1, 'eq' means equality that the equation = 0
+                    'jac': lambda weights: np.ones_like(weights)}
     solution = minimize(portfolio_tracking_error, init_guess,
                        args=(dependant_variable, explanatory_variables,),
                        method='SLSQP',
+                       jac=portfolio_tracking_error_gradient,
                        bounds = bounds,
                        constraints= (constraint_1,),
                        options={'disp':False})
@@ -941,6 +2017,25 @@ def weight_ew(r, cap_weights=None, max_cw_mult=None, microcap_threshold=None, **
             ew = ew/ew.sum() #reweight
     return ew
 
+def weight_ew_panel(r, estimation_window, cap_weights=None, max_cw_mult=None, microcap_threshold=None, **kwargs):
+    """
+    weight_ew for every window of backtest_ws at once: returns a (windows x assets) array whose row k
+    is weight_ew(r.iloc[k:k+estimation_window]) with the same microcap exclusion and capweight tether
+    """
+    n_windows = r.shape[0] - estimation_window
+    ew = np.full((n_windows, r.shape[1]), 1/r.shape[1])
+    if cap_weights is not None:
+        cw = cap_weights.loc[r.index[:n_windows], r.columns].values    # starting cap weight of each window
+        ## exclude microcaps
+        if microcap_threshold is not None and microcap_threshold > 0:
+            ew[cw < microcap_threshold] = 0
+            ew = ew/np.nansum(ew, axis=1, keepdims=True)
+        #limit weight to a multiple of capweight
+        if max_cw_mult is not None and max_cw_mult > 0:
+            ew = np.minimum(ew, cw*max_cw_mult)
+            ew = ew/np.nansum(ew, axis=1, keepdims=True) #reweight
+    return ew
+
 def weight_cw(r, cap_weights, **kwargs):
     """
     Returns the weights of the CW portfolio based on the time series of capweights
@@ -948,50 +2043,257 @@ def weight_cw(r, cap_weights, **kwargs):
     w = cap_weights.loc[r.index[0]]
     return w/w.sum()
 
-def backtest_ws(r, estimation_window=60, weighting=weight_ew, verbose=False, prices=None, **kwargs):
+def weight_cw_panel(r, estimation_window, cap_weights, **kwargs):
+    """
+    weight_cw for every window of backtest_ws at once, see weight_ew_panel. Like weight_cw the weights are normalised
+    over every column of cap_weights, not only the assets of r
+    """
+    w = cap_weights.loc[r.index[:r.shape[0] - estimation_window]]
+    return w.loc[:, r.columns].values/np.nansum(w.values, axis=1, keepdims=True)
+
+#Weighting schemes that only look at the first row of each window declare a panel version, which backtest_ws uses instead of the window loop
+weight_ew.vectorised = weight_ew_panel
+weight_cw.vectorised = weight_cw_panel
+
+#State of a backtest_ws worker process, set once per process by init_backtest_worker
+_backtest_worker = {}
+
+def init_backtest_worker(shm_name, shape, order, index, columns, weighting, kwargs, rolling_cov=False):
+    """
+    Process pool initializer for backtest_ws: attaches to the shared memory block holding the data and wraps it
+    in a DataFrame without copying, so the windows are never pickled
+    With rolling_cov the worker builds its own RollingCovariance on that frame, pool.map hands it runs of consecutive windows
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)     #The parent process owns the block and unlinks it
+    data = pd.DataFrame(np.ndarray(shape, dtype=np.float64, buffer=shm.buf, order=order), index=index, columns=columns, copy=False)
+    if rolling_cov:
+        kwargs = dict(kwargs, cov_engine=RollingCovariance(data))
+    _backtest_worker.update(shm=shm, data=data, weighting=weighting, kwargs=kwargs)
+
+def backtest_window(win):
+    """
+    Weights of one estimation window (start, end) in a backtest_ws worker process
+    """
+    data = _backtest_worker["data"]
+    return _backtest_worker["weighting"](data.iloc[win[0]:win[1]], **_backtest_worker["kwargs"])
+
+def backtest_ws(r, estimation_window=60, weighting=weight_ew, verbose=False, prices=None, n_jobs=None, rolling_cov=False, **kwargs):
     """
     Backtests a given weighting scheme, given some parameters:
     r : asset returns to use to build the portfolio
     estimation_window: the window to use to estimate parameters
     weighting: the weighting scheme to use, must be a function that takes "r", and a variable number of keyword-value arguments
+    If weighting has a "vectorised" attribute (see weight_ew_panel), it is called once with (r, estimation_window, **kwargs)
+    to produce all the weights in one go
+    n_jobs: number of worker processes to spread the windows over (-1 for all cores), the windows run serially if None or 1.
+    The data is placed once in shared memory and the results come back in window order, so they match the serial run.
+    weighting and kwargs must be picklable i.e. module level functions
+    rolling_cov: passes a RollingCovariance engine (cov_engine) down to the weighting, so sample_cov, cc_cov, shrinkage_cov
+    and ewma_cov slide their sums from one window to the next instead of recomputing them. With n_jobs every worker builds
+    its own engine on the shared data, so the engine is never pickled
     """
     n_periods = r.shape[0]
     # return windows
     windows = [(start, start+estimation_window) for start in range(n_periods-estimation_window)]
-    if prices is not None:
-        weights = [weighting(prices.iloc[win[0]:win[1]], **kwargs) for win in windows]
+    data = prices if prices is not None else r
+    vectorised = getattr(weighting, "vectorised", None)
+    parallel = vectorised is None and n_jobs is not None and n_jobs != 1 and len(windows) > 1
+    if rolling_cov and not parallel:        #The workers build their own engine on the shared data
+        kwargs["cov_engine"] = RollingCovariance(data)
+    if vectorised is not None:
+        weights = vectorised(data, estimation_window, **kwargs)
+    elif parallel:
+        import os
+        import numpy as np
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import shared_memory
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        values = data.values.astype(np.float64, copy=False)
+        #Keep the memory layout of the frame so the estimators sum in the same order as in the serial run
+        order = "F" if values.flags.f_contiguous and not values.flags.c_contiguous else "C"
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        try:
+            np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf, order=order)[:] = values
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_backtest_worker,
+                                     initargs=(shm.name, values.shape, order, data.index, data.columns, weighting, kwargs, rolling_cov)) as pool:
+                weights = list(pool.map(backtest_window, windows, chunksize=max(1, len(windows)//(4*n_jobs))))
+        finally:
+            shm.close()
+            shm.unlink()
     else:
-        weights = [weighting(r.iloc[win[0]:win[1]], **kwargs) for win in windows]
+        weights = [weighting(data.iloc[win[0]:win[1]], **kwargs) for win in windows]
     
     # convert List of weights to DataFrame
     weights = pd.DataFrame(weights, index=r.iloc[estimation_window:].index, columns=r.columns)
     returns = (weights * r).sum(axis="columns",  min_count=1) #mincount is to generate NAs if all inputs are NAs
     return returns
 
-def sample_cov(r, **kwargs):
+class RollingCovariance:
+    """
+    Rolling covariance engine for the estimation windows of backtest_ws
+    It keeps the pairwise sums, cross-products and observation counts of the current window (NaNs are skipped pairwise,
+    like DataFrame.cov/corr) and slides them by adding the new rows and removing the old ones, which costs O(N^2) per step
+    instead of O(W*N^2). The sums are rebuilt from scratch every "refresh" steps to stop rounding errors from accumulating
+    """
+    def __init__(self, data, refresh=250):
+        values = np.asarray(data.values, dtype=float)
+        self.index, self.columns, self.refresh = data.index, data.columns, refresh
+        #Covariances do not depend on the level, so centre the data on its mean to keep the raw sums well conditioned
+        self.mask = ~np.isnan(values)
+        self.complete = self.mask.all()     #Without NaNs the pairwise sums collapse to per column sums and a single count
+        self.shift = np.nanmean(values, axis=0)
+        self.x = np.where(self.mask, values - self.shift, 0.0)
+        self.ewma = {}                      #Decay factor -> (start, end, steps, unnormalised EWMA sum) of ewma_cov
+        self._sums(0, 0)
+        self.window = (0, 0)                #Rows of the last locate, the pairwise sums only follow when cov/corr need them
+
+    def _sums(self, start, end):
+        x = self.x[start:end]
+        self.sxy = x.T @ x                  #sum of x_i*x_j over the rows where both are observed (NaNs are zeros in x)
+        if self.complete:
+            self.sx, self.sxx, self.count = x.sum(axis=0), (x*x).sum(axis=0), float(end - start)
+        else:
+            m = self.mask[start:end].astype(float)
+            self.sx = x.T @ m               #sum of x_i over the rows where x_j is observed too
+            self.sxx = (x*x).T @ m          #sum of x_i**2 over the rows where x_j is observed too
+            self.count = m.T @ m            #number of rows where both are observed
+        self.start, self.end, self.steps = start, end, 0
+
+    def _update(self, rows, signs):
+        x = self.x[rows]
+        sx = signs[:, None]*x               #+1 for the rows coming into the window, -1 for the rows leaving it
+        self.sxy += x.T @ sx
+        if self.complete:
+            self.sx += sx.sum(axis=0)
+            self.sxx += (sx*x).sum(axis=0)
+            self.count += signs.sum()
+        else:
+            sm = signs[:, None]*self.mask[rows]
+            self.sx += x.T @ sm
+            self.sxx += (x*x).T @ sm
+            self.count += self.mask[rows].T.astype(float) @ sm
+
+    def move(self, start, end):
+        """
+        Moves the window to the rows [start, end), incrementally if that is cheaper than starting over
+        """
+        n_moves = abs(start - self.start) + abs(end - self.end)
+        if start < self.start or end < self.end or n_moves >= end - start or self.steps + n_moves > self.refresh:
+            self._sums(start, end)
+            return
+        rows = np.r_[self.end:end, self.start:start]
+        self._update(rows, np.r_[np.ones(end - self.end), -np.ones(start - self.start)])
+        self.start, self.end = start, end
+        self.steps += n_moves
+
+    def locate(self, r):
+        """
+        Points the window at the rows of r (a slice of the data the engine was built on), returns False if r is not one
+        """
+        if not r.columns.equals(self.columns) or r.shape[0] == 0:
+            return False
+        try:
+            start = self.index.get_loc(r.index[0])
+        except KeyError:
+            return False
+        if not isinstance(start, (int, np.integer)) or not self.index[start:start + r.shape[0]].equals(r.index):
+            return False
+        self.window = (start, start + r.shape[0])
+        return True
+
+    def ewma_cov(self, lam=0.94):
+        """
+        Exponentially weighted (RiskMetrics, zero mean) covariance matrix of the current window, see ewma_cov
+        Moving the window forward decays the previous sum by lam per new row, adds the new rows and removes the old ones
+        with the weights they had, which is S = lam*S + (1-lam)*x_new x_new' - (1-lam)*lam**W * x_old x_old' for one row
+        """
+        start, end = self.window
+        window = end - start
+        raw = lambda rows: np.where(self.mask[rows], self.x[rows] + self.shift, 0.0)    #Missing returns count as zero
+        weights = lambda rows: (1 - lam)*lam**(end - 1 - np.arange(rows.start, rows.stop))    #Most recent row gets the largest weight
+        state = self.ewma.get(lam)
+        if state is not None and state[0] <= start and state[1] <= end \
+                and (start - state[0]) + (end - state[1]) < window and state[2] + end - state[1] <= self.refresh:
+            s_0, e_0, steps, total = state
+            new, old = slice(e_0, end), slice(s_0, start)
+            x_new, x_old = raw(new), raw(old)
+            total *= lam**(end - e_0)
+            total += (x_new*weights(new)[:, None]).T @ x_new
+            total -= (x_old*weights(old)[:, None]).T @ x_old
+            steps += end - e_0
+        else:
+            x = raw(slice(start, end))
+            total, steps = (x*weights(slice(start, end))[:, None]).T @ x, 0
+        self.ewma[lam] = (start, end, steps, total)
+        return pd.DataFrame(total/(1 - lam**window), index=self.columns, columns=self.columns)
+
+    def _pairwise(self):
+        """
+        Sums of x_i and x_i**2 over the rows where x_j is observed, as (i, j) and (j, i) arrays that broadcast to N x N
+        """
+        self.move(*self.window)
+        if self.complete:
+            return self.sx[:, None], self.sx[None, :], self.sxx[:, None], self.sxx[None, :]
+        return self.sx, self.sx.T, self.sxx, self.sxx.T
+
+    def cov(self):
+        """
+        Pairwise sample covariance matrix of the current window
+        """
+        sx_ij, sx_ji, _, _ = self._pairwise()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov = (self.sxy - sx_ij*sx_ji/self.count)/(self.count - 1)
+        cov[np.broadcast_to(self.count < 2, cov.shape)] = np.nan
+        return pd.DataFrame(cov, index=self.columns, columns=self.columns)
+
+    def corr(self):
+        """
+        Pairwise correlation matrix of the current window, each pair uses the variances over the rows where both are observed
+        """
+        sx_ij, sx_ji, sxx_ij, sxx_ji = self._pairwise()
+        count = np.broadcast_to(self.count, self.sxy.shape)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov = self.sxy - sx_ij*sx_ji/count
+            corr = cov/np.sqrt((sxx_ij - sx_ij**2/count)*(sxx_ji - sx_ji**2/count))
+        corr[count < 2] = np.nan
+        np.fill_diagonal(corr, np.where(np.diag(count) < 2, np.nan, 1.0))
+        return pd.DataFrame(np.clip(corr, -1, 1), index=self.columns, columns=self.columns)
+
+def sample_cov(r, cov_engine=None, **kwargs):
     """
     Returns the sample covariance of the supplied returns
+    Inside backtest_ws(rolling_cov=True) the estimate comes from the RollingCovariance engine of the backtest
     """
+    if cov_engine is not None and cov_engine.locate(r):
+        return cov_engine.cov()
     return r.cov()
 
-def weight_gmv(r, cov_estimator=sample_cov, **kwargs):
+def weight_gmv(r, cov_estimator=sample_cov, backend="slsqp", allow_short=False, **kwargs):
     """
     Produces the weights of the GMV portfolio given a covariance matrix of the returns 
+    backend and allow_short are passed on to gmv, backend="closed" makes most rolling windows a single Cholesky solve
     """
     est_cov = cov_estimator(r, **kwargs)
-    return gmv(est_cov)
+    return gmv(est_cov, backend=backend, allow_short=allow_short)
 
-def cc_cov(r, **kwargs):
+def cc_cov(r, cov_engine=None, **kwargs):
     """
     Estimates a covariance matrix by using the Elton/Gruber Constant Correlation model
+    Inside backtest_ws(rolling_cov=True) the correlations and volatilities come from the RollingCovariance engine of the backtest
     """
-    rhos = r.corr()
+    if cov_engine is not None and cov_engine.locate(r):
+        rhos = cov_engine.corr()
+        sd = pd.Series(np.sqrt(np.diag(cov_engine.cov().values)), index=r.columns)
+    else:
+        rhos = r.corr()
+        sd = r.std()
     n = rhos.shape[0]
     # this is a symmetric matrix with diagonals all 1 - so the mean correlation is ...
     rho_bar = (rhos.values.sum()-n)/(n*(n-1))
     ccor = np.full_like(rhos, rho_bar)
     np.fill_diagonal(ccor, 1.)
-    sd = r.std()
     return pd.DataFrame(ccor * np.outer(sd, sd), index=r.columns, columns=r.columns)
 
 def shrinkage_cov(r, delta=0.5, **kwargs):
@@ -1001,3 +2303,49 @@ def shrinkage_cov(r, delta=0.5, **kwargs):
     prior = cc_cov(r, **kwargs)
     sample = sample_cov(r, **kwargs)
     return delta*prior + (1-delta)*sample
+
+def ewma_cov(r, lam=0.94, cov_engine=None, **kwargs):
+    """
+    Exponentially weighted (RiskMetrics) covariance estimator: zero mean, the return k periods before the last one
+    has weight (1-lam)*lam**k, normalised over the window. Missing returns count as zero
+    With a RollingCovariance engine built on the full returns as cov_engine (backtest_ws(rolling_cov=True) and MDemo's
+    sharpe_bt pass one) it is updated recursively from one window to the next instead of recomputed
+    """
+    if cov_engine is not None and cov_engine.locate(r):
+        return cov_engine.ewma_cov(lam)
+    x = r.fillna(0).values
+    weights = (1 - lam)*lam**np.arange(x.shape[0] - 1, -1, -1)
+    return pd.DataFrame((x*weights[:, None]).T @ x/weights.sum(), index=r.columns, columns=r.columns)
+
+def lw_shrinkage_intensity(r):
+    """
+    Ledoit-Wolf (2004) optimal shrinkage intensity of the sample covariance towards the constant correlation target
+    i.e. delta = max(0, min(1, (pi - rho)/gamma/T)), where pi is the sum of the asymptotic variances of the sample
+    covariances, rho their covariances with the target and gamma the squared distance between the target and the sample
+    Rows with missing values are dropped
+    """
+    x = r.dropna().values
+    t, n = x.shape
+    x = x - x.mean(axis=0)
+    sample = x.T @ x/t
+    var = np.diag(sample)
+    sqrtvar = np.sqrt(var)
+    r_bar = ((sample/np.outer(sqrtvar, sqrtvar)).sum() - n)/(n*(n-1))
+    prior = r_bar*np.outer(sqrtvar, sqrtvar)
+    np.fill_diagonal(prior, var)
+
+    y = x**2
+    pi = (y.T @ y).sum()/t - (sample**2).sum()
+    rho_diag = (y**2).sum()/t - (var**2).sum()
+    theta = (x**3).T @ x/t - var[:, None]*sample          #theta_ii,ij: covariance of x_i**2 and x_i*x_j
+    np.fill_diagonal(theta, 0)
+    rho = rho_diag + r_bar*((sqrtvar[None, :]/sqrtvar[:, None])*theta).sum()
+    gamma = ((sample - prior)**2).sum()
+    return max(0.0, min(1.0, (pi - rho)/gamma/t)) if gamma > 0 else 0.0
+
+def lw_shrinkage_cov(r, **kwargs):
+    """
+    Covariance estimator that shrinks the Sample Covariance towards the Constant Correlation Estimator with the
+    Ledoit-Wolf optimal intensity instead of a hand-picked delta (see shrinkage_cov and lw_shrinkage_intensity)
+    """
+    return shrinkage_cov(r, delta=lw_shrinkage_intensity(r), **kwargs)
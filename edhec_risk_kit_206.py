@@ -664,6 +664,27 @@ def risk_contribution(w,cov):
     risk_contrib = np.multiply(marginal_contrib,w.T)/total_portfolio_var
     return risk_contrib
 
+def msd_risk(weights, target_risk, cov):
+    """
+    Returns the Mean Squared Difference in risk contributions
+    between weights and target_risk
+    """
+    w_contribs = risk_contribution(weights, cov)
+    return ((w_contribs-target_risk)**2).sum()
+
+def msd_risk_gradient(weights, target_risk, cov):
+    """
+    Returns the gradient of msd_risk with respect to the weights
+    With m = cov@w, V = w'cov w and d = 2*(risk contributions - target_risk), this is
+    (d*m + cov@(d*w))/V - 2*m*(d'(w*m))/V**2
+    """
+    cov = np.asarray(cov)
+    marginal_contrib = cov @ weights
+    total_portfolio_var = weights @ marginal_contrib
+    d = 2*(weights*marginal_contrib/total_portfolio_var - np.asarray(target_risk))
+    return (d*marginal_contrib + cov @ (d*weights))/total_portfolio_var \
+           - 2*marginal_contrib*(d @ (weights*marginal_contrib))/total_portfolio_var**2
+
 def target_risk_contributions(target_risk, cov):
     """
     Returns the weights of the portfolio that gives you the weights such
@@ -675,18 +696,13 @@ def target_risk_contributions(target_risk, cov):
     bounds = ((0.0, 1.0),) * n # an N-tuple of 2-tuples!
     # construct the constraints
     weights_sum_to_1 = {'type': 'eq',
-                        'fun': lambda weights: np.sum(weights) - 1
+                        'fun': lambda weights: np.sum(weights) - 1,
+                        'jac': lambda weights: np.ones_like(weights)
     }
-    def msd_risk(weights, target_risk, cov):
-        """
-        Returns the Mean Squared Difference in risk contributions
-        between weights and target_risk
-        """
-        w_contribs = risk_contribution(weights, cov)
-        return ((w_contribs-target_risk)**2).sum()
-    
+    # analytic gradient, so SLSQP does not fall back to finite differences
     weights = minimize(msd_risk, init_guess,
                        args=(target_risk, cov), method='SLSQP',
+                       jac=msd_risk_gradient,
                        options={'disp': False},
                        constraints=(weights_sum_to_1,),
                        bounds=bounds)
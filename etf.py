@@ -30,42 +30,36 @@ from pandas.tseries import offsets
 from IPython.core.display import display, HTML
 
 def drawdowns2020(data):
-    return_series = pd.DataFrame(data.pct_change().dropna()[str(date.today().year):])
-    wealth_index = 1000*(1+return_series).cumprod()
-    previous_peaks = wealth_index.cummax()
-    drawdowns = (wealth_index - previous_peaks)/previous_peaks
-    return drawdowns.min(axis=0)
+    return erk.drawdown_stats(data.ffill()[str(date.today().year):].pct_change())["Summary"]["Max Drawdown"]
 
 def returns_heatmap(data, max_drawdowns, title, tickers, sortby='1-Day', reit='No', currencies='No', alok_secs='No', fg_data='No', india='No', style='Yes'):
     """
 
     """
     if reit=='Yes':
-        df = pd.DataFrame(data = (data.pct_change(1).iloc[-1,:], data.pct_change(5).iloc[-1,:], data.pct_change(21).iloc[-1,:], data.pct_change(63).iloc[-1,:], data['2020':].iloc[-1,:]/data['2020':].iloc[0,:]-1, data['2020':].iloc[-1,:]/data['2020-03-23':].iloc[0,:]-1, data.pct_change(126).iloc[-1,:], data.pct_change(252).iloc[-1,:], max_drawdowns))
-        df.index = ['1-Day', '1-Week', '1-Month', '3-Month', 'YTD', 'March-23 TD', '6-Month', '1-Year', 'Drawdowns']
+        horizons = {'1-Day': 1, '1-Week': 5, '1-Month': 21, '3-Month': 63, 'YTD': '2020-01-01', 'March-23 TD': '2020-03-23', '6-Month': 126, '1-Year': 252}
 
     elif currencies=='Yes':
-        df = pd.DataFrame(data = (data.pct_change(1).iloc[-1,:],  data.pct_change(5).iloc[-1,:], data.pct_change(21).iloc[-1,:], data.pct_change(42).iloc[-1,:], data.pct_change(63).iloc[-1,:], data['2020':].iloc[-1,:]/data['2020':].iloc[0,:]-1, data['2020':].iloc[-1,:]/data['2020-03-23':].iloc[0,:]-1, data.pct_change(126).iloc[-1,:], data.pct_change(252).iloc[-1,:], max_drawdowns))
-        df.index = ['1-Day', '1-Week', '1-Month', '2-Month', '3-Month', 'YTD', 'March-23 TD', '6-Month', '1-Year', 'Drawdowns']
+        horizons = {'1-Day': 1, '1-Week': 5, '1-Month': 21, '2-Month': 42, '3-Month': 63, 'YTD': '2020-01-01', 'March-23 TD': '2020-03-23', '6-Month': 126, '1-Year': 252}
 
     elif alok_secs=='Yes':
-        data = data.ffill()
-        df = pd.DataFrame(data = (data.pct_change(1).iloc[-1,:],  data.pct_change(5).iloc[-1,:], data.pct_change(21).iloc[-1,:], data.pct_change(42).iloc[-1,:], data.pct_change(63).iloc[-1,:], data['2020':].iloc[-1,:]/data['2020-01-06':].iloc[0,:]-1, data['2020':].iloc[-1,:]/data['2020-03-23':].iloc[0,:]-1, max_drawdowns))
-        df.index = ['1-Day', '1-Week', '1-Month', '2-Month', '3-Month', 'YTD', 'March-23 TD', 'Drawdowns']
+        horizons = {'1-Day': 1, '1-Week': 5, '1-Month': 21, '2-Month': 42, '3-Month': 63, 'YTD': '2020-01-06', 'March-23 TD': '2020-03-23'}
 
     elif fg_data=='Yes':
         now = time.localtime()
         last = datetime.date(now.tm_year, now.tm_mon, 1) - datetime.timedelta(1)
-        df = pd.DataFrame(data = (data.pct_change(1).iloc[-1,:],  data.pct_change(7).iloc[-1,:], data.pct_change(30).iloc[-1,:], data.iloc[-1,:]/data[last:].iloc[0,:]-1, data.pct_change(90).iloc[-1,:]))
-        df.index = ['1-Day', '1-Week', '1-Month', 'MTD', '3-Month']
-
+        horizons = {'1-Day': 1, '1-Week': 7, '1-Month': 30, 'MTD': last, '3-Month': 90}
 
     else:
-        df = pd.DataFrame(data = (data.pct_change(1).iloc[-1,:], data.pct_change(5).iloc[-1,:], data.pct_change(21).iloc[-1,:], data.pct_change(63).iloc[-1,:], data['2020':].iloc[-1,:]/data['2020':].iloc[0,:]-1, data['2020':].iloc[-1,:]/data['2020-03-23':].iloc[0,:]-1, data.pct_change(126).iloc[-1,:], data.pct_change(252).iloc[-1,:], data.pct_change(252*3).iloc[-1,:], max_drawdowns))
-        df.index = ['1-Day', '1-Week', '1-Month', '3-Month', 'YTD', 'March-23 TD', '6-Month', '1-Year', '3-Year', 'Drawdowns']
+        horizons = {'1-Day': 1, '1-Week': 5, '1-Month': 21, '3-Month': 63, 'YTD': '2020-01-01', 'March-23 TD': '2020-03-23', '6-Month': 126, '1-Year': 252, '3-Year': 252*3}
+
+    #All the horizons come out of one lookup in the cumulative log return index of the (forward filled) prices
+    df = erk.horizon_returns(data, horizons)
+    if fg_data!='Yes':
+        df['Drawdowns'] = max_drawdowns
 
 
-    df_perf = (df.T*100)
+    df_perf = (df*100)
     if india=='No':
         df_perf.insert(loc=0, column='Tickers', value=list(tickers))
         df_perf = df_perf.sort_values(by=sortby, ascending=False)
@@ -96,11 +90,10 @@ def returns_heatmap_alok(data, max_drawdowns, title, sortby='1-Day', style='Yes'
     """
 
     """
-    data = data.ffill()
-    df = pd.DataFrame(data = (data.pct_change(1).iloc[-1,:],  data.pct_change(5).iloc[-1,:], data.pct_change(21).iloc[-1,:], data.pct_change(63).iloc[-1,:], data.pct_change(126).iloc[-1,:], data['2020':].iloc[-1,:]/data['2020-01-06':].iloc[0,:]-1, data['2020':].iloc[-1,:]/data['2020-03-23':].iloc[0,:]-1, max_drawdowns))
-    df.index = ['1-Day', '1-Week', '1-Month', '3-Month', '6-Month', 'YTD', 'March-23 TD', 'Drawdowns']
+    df = erk.horizon_returns(data, {'1-Day': 1, '1-Week': 5, '1-Month': 21, '3-Month': 63, '6-Month': 126, 'YTD': '2020-01-06', 'March-23 TD': '2020-03-23'})
+    df['Drawdowns'] = max_drawdowns
 
-    df_perf = (df.T*100)
+    df_perf = (df*100)
     df_perf = df_perf.sort_values(by=sortby, ascending=False)
     df_perf.index.name = title
 
@@ -297,10 +290,10 @@ def import_data(asset_class, sortby='1-Day'):
 
 
     #Generate multi timeframe returns table
-    df0 = pd.DataFrame(data = (df1.pct_change(1).iloc[-1,:], df1.pct_change(5).iloc[-1,:], df1.pct_change(21).iloc[-1,:], df1.pct_change(63).iloc[-1,:], df1['2020':].iloc[-1,:]/df1['2020':].iloc[0,:]-1, df1['2020':].iloc[-1,:]/df1['2020-03-23':].iloc[0,:]-1, df1.pct_change(126).iloc[-1,:], df1.pct_change(252).iloc[-1,:], drawdowns2020(df1)))
-    df0.index = ['1-Day', '1-Week', '1-Month', '3-Month', 'YTD', 'March-23 TD', '6-Month', '1-Year', 'Drawdowns']
+    df0 = erk.horizon_returns(df1, {'1-Day': 1, '1-Week': 5, '1-Month': 21, '3-Month': 63, 'YTD': '2020-01-01', 'March-23 TD': '2020-03-23', '6-Month': 126, '1-Year': 252})
+    df0['Drawdowns'] = drawdowns2020(df1)
 
-    df_perf = (df0.T*100)
+    df_perf = (df0*100)
     df_perf.index.name = asset_class
 
 
@@ -416,10 +409,7 @@ def updated_world_indices(category='Major'):
     #Local Currency Returns Table
     oned_lcl = pd.concat([df1.iloc[-1,:],
                          df1.iloc[-1,:]-df1.iloc[-2,:],
-                        (df1.iloc[-1,:]/df1.iloc[-2,:]-1),
-                        (df1.iloc[-1,:]/df1.iloc[-6,:]-1),
-                        (df1.iloc[-1,:]/df1.iloc[-22,:]-1),
-                        (df1.iloc[-1,:]/df1.iloc[0,:]-1)], axis=1)
+                         erk.horizon_returns(df1, [1, 5, 21, (None, None)])], axis=1)
     oned_lcl.columns = ['Price (EOD)','1D Chg', '1D Chg (%)', '1W Chg (%)', '1M Chg (%)', 'Chg YTD (%)']
     
     #Add Country and Currency Names
@@ -444,10 +434,7 @@ def updated_world_indices(category='Major'):
     #Calculate Currency Returns
     oned_ccy = pd.concat([ccys.iloc[-1,:],
                              ccys.iloc[-1,:]-ccys.iloc[-2,:],
-                            (ccys.iloc[-1,:]/ccys.iloc[-2,:]-1),
-                            (ccys.iloc[-1,:]/ccys.iloc[-6,:]-1),
-                            (ccys.iloc[-1,:]/ccys.iloc[-22,:]-1),
-                            (ccys.iloc[-1,:]/ccys.iloc[0,:]-1)], axis=1)
+                             erk.horizon_returns(ccys, [1, 5, 21, (None, None)])], axis=1)
     oned_ccy.columns = ['Price (EOD)','1D Chg', '1D CChg (%)', '1W CChg (%)', '1M CChg (%)', 'CChg YTD (%)']
     
     abc = oned_ccy.copy()
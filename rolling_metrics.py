@@ -0,0 +1,232 @@
+"""
+Rolling versions of the risk metrics in edhec_risk_kit, computed for every column and every window end in one go
+instead of r.rolling(window).apply(...) loops
+
+Each function takes a Series or DataFrame of returns and a window length and returns a Series or DataFrame of the same
+shape, with the value of the metric over the trailing window ending at each row. The first window-1 rows and any window
+with missing returns are NaN, like r.rolling(window).apply(...)
+
+The historic VaR/CVaR keep one Fenwick (binary indexed) tree of the ranks in the window per column, so each step is an
+O(log n) insertion, deletion and order statistic lookup. The parametric measures come from running sums of the powers
+of the returns
+"""
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+
+def _as_array(r):
+    """
+    Returns the returns as a T x N float array, and a function that wraps a T x N result like r
+    """
+    if isinstance(r, pd.Series):
+        return r.values.astype(float)[:, None], lambda x: pd.Series(x[:, 0], index=r.index, name=r.name)
+    elif isinstance(r, pd.DataFrame):
+        return r.values.astype(float), lambda x: pd.DataFrame(x, index=r.index, columns=r.columns)
+    else:
+        raise TypeError("Expected r to be a Series or a DataFrame")
+
+
+def _window_sums(x, window):
+    """
+    Sum of each column of x over the trailing window ending at every row (NaN for the first window-1 rows)
+    """
+    totals = np.full(x.shape, np.nan)
+    cumulative = np.concatenate([np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)])
+    totals[window-1:] = cumulative[window:] - cumulative[:-window]
+    return totals
+
+
+def _complete_windows(x, window):
+    """
+    True where the trailing window has no missing value
+    """
+    return _window_sums(np.isnan(x).astype(float), window) == 0
+
+
+def _fenwick_add(tree, pos, cols, delta, levels):
+    """
+    Adds delta at the 1-based positions pos of the trees in the columns cols of tree, for all the columns at once
+    The trees have 2**levels positions, the updates that climb past the root land in the spare last row
+    """
+    spare = tree.shape[0] - 1
+    for _ in range(levels + 1):
+        tree[pos, cols] += delta
+        pos = np.minimum(pos + (pos & -pos), spare)
+
+
+def _fenwick_prefix(tree, pos, cols, levels):
+    """
+    Sums of the trees up to and including the 1-based positions pos (row 0 stays empty)
+    """
+    total = np.zeros(pos.shape[0])
+    for _ in range(levels + 1):
+        total += tree[pos, cols]
+        pos = pos - (pos & -pos)
+    return total
+
+
+def _fenwick_kth(tree, k, cols, levels):
+    """
+    1-based position of the k-th element counted by the trees (binary lifting over the implicit tree)
+    """
+    pos = np.zeros(k.shape[0], dtype=np.int64)
+    spare = tree.shape[0] - 1
+    for level in range(levels, -1, -1):
+        nxt = np.minimum(pos + (1 << level), spare)
+        below = tree[nxt, cols]
+        ok = below < k
+        pos = np.where(ok, nxt, pos)
+        k = np.where(ok, k - below, k)
+    return pos + 1
+
+
+def _historic_tail(x, window, level, cvar):
+    """
+    Rolling -percentile(level) of each column, and the rolling -mean of the returns at or below it if cvar
+    """
+    t, n = x.shape
+    #Rank of every return in its column: ranks turn the window into a set of integers a Fenwick tree can count
+    order = np.argsort(x, axis=0, kind="stable")                #NaNs sort last and are never counted
+    sorted_x = np.take_along_axis(x, order, axis=0)
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(t)[:, None], axis=0)
+    #Last rank of each run of equal values, so the tail "r <= VaR" includes all the ties
+    run_end = np.where(np.vstack([sorted_x[1:] != sorted_x[:-1], np.ones((1, n), dtype=bool)]), np.arange(t)[:, None], t)
+    run_end = np.minimum.accumulate(run_end[::-1], axis=0)[::-1]
+
+    #One tree per column counting the ranks in the window and, for the CVaR, one summing their returns (columns n to 2n)
+    levels = max(int(np.ceil(np.log2(t))), 0)
+    n_trees = 2*n if cvar else n
+    tree = np.zeros(((1 << levels) + 2, n_trees))
+    cols = np.arange(n)
+    tree_cols = np.arange(n_trees)
+    valid = ~np.isnan(x)
+    deltas = valid.astype(float)
+    if cvar:
+        deltas = np.hstack([deltas, np.where(valid, x, 0.0)])
+    positions = np.tile(rank + 1, (1, n_trees//n))
+
+    var = np.full((t, n), np.nan)
+    tail = np.full((t, n), np.nan)
+    complete = _complete_windows(x, window)
+    #np.percentile interpolates linearly between the order statistics around level/100*(window-1)
+    position = level/100*(window - 1)
+    lo = int(np.floor(position))
+    hi = min(lo + 1, window - 1)
+    frac = position - lo
+    #Both order statistics (and both CVaR prefix sums) are looked up in a single pass over the stacked columns
+    k_both = np.repeat([lo + 1.0, hi + 1.0], n)
+    cols_both = np.tile(cols, 2)
+    for end in range(t):
+        _fenwick_add(tree, positions[end], tree_cols, deltas[end], levels)
+        if end >= window:
+            _fenwick_add(tree, positions[end - window], tree_cols, -deltas[end - window], levels)
+        if end < window - 1 or not complete[end].any():
+            continue
+        ranks = np.minimum(_fenwick_kth(tree, k_both, cols_both, levels) - 1, t - 1)    #Clipped for the incomplete windows
+        rank_lo, rank_hi = ranks[:n], ranks[n:]
+        x_lo, x_hi = sorted_x[rank_lo, cols], sorted_x[rank_hi, cols]
+        q = x_lo + frac*(x_hi - x_lo)
+        var[end] = -q
+        if cvar:
+            last = np.where(x_hi <= q, run_end[rank_hi, cols], run_end[rank_lo, cols]) + 1
+            count_and_sum = _fenwick_prefix(tree, np.tile(last, 2), tree_cols, levels)
+            tail[end] = -count_and_sum[n:]/count_and_sum[:n]
+    var[~complete] = np.nan
+    tail[~complete] = np.nan
+    return var, tail
+
+
+def rolling_var_historic(r, window, level=5):
+    """
+    Rolling historic Value at Risk, see erk.var_historic
+    """
+    x, wrap = _as_array(r)
+    return wrap(_historic_tail(x, window, level, cvar=False)[0])
+
+
+def rolling_cvar_historic(r, window, level=5):
+    """
+    Rolling historic Conditional Value at Risk, see erk.cvar_historic
+    """
+    x, wrap = _as_array(r)
+    return wrap(_historic_tail(x, window, level, cvar=True)[1])
+
+
+def rolling_moments(r, window):
+    """
+    Rolling mean, population standard deviation (ddof=0), skewness and kurtosis (see erk.skewness, erk.kurtosis)
+    from running sums of the first four powers of the returns. Returns a dict of Series/DataFrames
+    """
+    x, wrap = _as_array(r)
+    complete = _complete_windows(x, window)
+    c = np.nan_to_num(x - np.nanmean(x, axis=0))        #Centred on the full sample mean to keep the power sums well conditioned
+    s1, s2, s3, s4 = (_window_sums(c**p, window)/window for p in (1, 2, 3, 4))
+    m2 = s2 - s1**2
+    m3 = s3 - 3*s1*s2 + 2*s1**3
+    m4 = s4 - 4*s1*s3 + 6*s1**2*s2 - 3*s1**4
+    mean = s1 + np.nanmean(x, axis=0)
+    sd = np.sqrt(np.maximum(m2, 0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        moments = {"mean": mean, "std": sd, "skewness": m3/sd**3, "kurtosis": m4/m2**2}
+    return {name: wrap(np.where(complete, value, np.nan)) for name, value in moments.items()}
+
+
+def rolling_gaussian_var(r, window, level=5, modified=False):
+    """
+    Rolling Gaussian VaR, or Cornish-Fisher VaR if modified=True, see erk.gaussian_var
+    """
+    moments = rolling_moments(r, window)
+    z = norm.ppf(level/100)
+    if modified:
+        s, k = moments["skewness"], moments["kurtosis"]
+        z = (z +
+                (z**2-1)*s/6 +
+                (z**3-3*z)*(k-3)/24 -
+                (2*z**3 - 5*z)*(s**2)/36
+            )
+    return -(moments["mean"] + z*moments["std"])
+
+
+def rolling_vol(r, window, periods_per_year):
+    """
+    Rolling annualized volatility (ddof=1), see erk.annualized_vol. NaN for window=1 like pandas
+    """
+    sd = rolling_moments(r, window)["std"]
+    ddof_correction = np.sqrt(window/(window - 1)) if window > 1 else np.nan
+    return sd*ddof_correction*np.sqrt(periods_per_year)
+
+
+def rolling_sharpe_ratio(r, window, periods_per_year, rf):
+    """
+    Rolling annualized sharpe ratio, see erk.sharpe_ratio: the compounded excess return over the window is the
+    exponential of a running sum of log(1 + excess return)
+    """
+    x, wrap = _as_array(r)
+    rf_per_period = (1+rf)**(1/periods_per_year)-1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_growth = _window_sums(np.log1p(np.nan_to_num(x) - rf_per_period), window)
+    ann_excess_ret = np.expm1(log_growth*periods_per_year/window)
+    return wrap(ann_excess_ret)/rolling_vol(r, window, periods_per_year)
+
+
+def rolling_max_drawdown(r, window):
+    """
+    Rolling maximum drawdown of the wealth index restarted at the beginning of each window, see erk.drawdown
+    Walks the offsets within the window, carrying the running peak and the worst drawdown of all the windows at once
+    """
+    x, wrap = _as_array(r)
+    t = x.shape[0]
+    result = np.full(x.shape, np.nan)
+    if t >= window:
+        wealth_index = np.cumprod(1 + np.nan_to_num(x), axis=0)   #Drawdowns do not depend on the starting wealth
+        n_windows = t - window + 1
+        peaks = wealth_index[:n_windows].copy()
+        worst = np.ones_like(peaks)
+        for offset in range(1, window):
+            wealth = wealth_index[offset:offset + n_windows]
+            np.maximum(peaks, wealth, out=peaks)
+            np.minimum(worst, wealth/peaks, out=worst)
+        result[window-1:] = worst - 1
+    return wrap(np.where(_complete_windows(x, window), result, np.nan))
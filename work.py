@@ -404,8 +404,7 @@ def updated_world_indices(category='Major', timeframe='Daily'):
     #Local Currency Returns Table
     oned_lcl = pd.concat([df1.iloc[-1,:],
                          df1.iloc[-1,:]-df1.iloc[pos,:],
-                        (df1.iloc[-1,:]/df1.iloc[pos,:]-1),
-                        (df1.iloc[-1,:]/df1.iloc[0,:]-1)], axis=1)
+                         erk.horizon_returns(df1, {'Chg (%)': -1-pos, 'Chg YTD (%)': (None, None)})], axis=1)
     oned_lcl.columns = ['Price (EOD)','Chg', 'Chg (%)', 'Chg YTD (%)']
     
     #Add Country and Currency Names
@@ -430,8 +429,7 @@ def updated_world_indices(category='Major', timeframe='Daily'):
     #Calculate Currency Returns
     oned_ccy = pd.concat([ccys.iloc[-1,:],
                              ccys.iloc[-1,:]-ccys.iloc[pos,:],
-                            (ccys.iloc[-1,:]/ccys.iloc[pos,:]-1),
-                            (ccys.iloc[-1,:]/ccys.iloc[0,:]-1)], axis=1)
+                             erk.horizon_returns(ccys, {'CChg (%)': -1-pos, 'CChg YTD (%)': (None, None)})], axis=1)
     oned_ccy.columns = ['Price (EOD)','Chg', 'CChg (%)', 'CChg YTD (%)']
     
     abc = oned_ccy.copy()
@@ -620,12 +618,7 @@ def drawdowns(data):
     """
     Max Drawdown in the current calendar year
     """
-    data = data.ffill()
-    return_series = pd.DataFrame(data.pct_change().dropna()[str(date.today().year):])
-    wealth_index = 1000*(1+return_series).cumprod()
-    previous_peaks = wealth_index.cummax()
-    drawdowns = (wealth_index - previous_peaks)/previous_peaks
-    return drawdowns.min(axis=0)
+    return erk.drawdown_stats(data.ffill()[str(date.today().year):].pct_change())["Summary"]["Max Drawdown"]
 
 def usd_indices_rets(df, start = '2020-03-23', end = date.today() - timedelta(1), teny='No', major='No'):
     tens=pd.read_excel('Regional Indices.xlsx', sheet_name='10Y', engine='openpyxl')['10Y'].to_list()
@@ -639,13 +632,12 @@ def usd_indices_rets(df, start = '2020-03-23', end = date.today() - timedelta(1)
         reg_indices=df[2]
         
     cntry_list = reg_indices['Country']
-    year = date.today().year 
-    df = pd.DataFrame(data = (data.iloc[-1,:], data.pct_change(1).iloc[-1,:], data.pct_change(5).iloc[-1,:], data.pct_change(21).iloc[-1,:],
-                                  data.pct_change(63).iloc[-1,:], data.pct_change(126).iloc[-1,:], data[str(year):].iloc[-1,:]/data[str(year):].iloc[0,:]-1,
-                                  data.pct_change(252).iloc[-1,:], data[start:end].iloc[-1,:]/data[start:end].iloc[0,:]-1, drawdowns(data)))
-    df.index = ['Price','1-Day', '1-Week', '1-Month', '3-Month', '6-Month', 'YTD', '1-Year', 'Custom', 'Max DD']
-    df = df[list(reg_indices[reg_indices.columns[0]])]
-    df = df.T
+    #Every horizon is read off the same cumulative log return index instead of a pct_change over the whole history
+    df = erk.horizon_returns(data, {'1-Day': 1, '1-Week': 5, '1-Month': 21, '3-Month': 63, '6-Month': 126,
+                                    'YTD': 'YTD', '1-Year': 252, 'Custom': (start, end)})
+    df.insert(0, 'Price', data.iloc[-1,:])
+    df['Max DD'] = drawdowns(data)
+    df = df.loc[list(reg_indices[reg_indices.columns[0]])]
     df['Price'] = cntry[reg_indices[reg_indices.columns[0]]].iloc[-1,:]
     df.iloc[:,1:] = (df.iloc[:,1:]*100)
     df.index.name = 'Indices'